@@ -0,0 +1,236 @@
+"""
+Batch simulation of many (program, input) pairs on a process pool.
+
+Manifest is a JSON list of cases: {"program": <translated program>, "input": <input file>, "name": <optional>}.
+Relative paths are resolved against the manifest directory. The microcode ROM is
+generated once in the parent process and handed to every worker on start.
+
+The "simd" engine runs all inputs of one program in lockstep (see simd_sim.py),
+one task per program.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from cache import Cache, add_cache_arguments, cache_config
+from control_unit import TICK_LIMIT, ControlUnit, load_data_path
+from data_path import add_memory_arguments, memory_config
+from fast_machine import InstructionMachine
+from fetch import FetchUnit, add_fetch_arguments, fetch_config
+from mc_generator import generate_mc
+from simd_sim import SimdMachine
+
+ENGINES = ["microcode", "predecoded", "instruction", "jit", "simd"]
+
+_microcode = None
+
+
+def _init_worker(microcode):
+    global _microcode
+    _microcode = microcode
+    # "input buffer is empty" warnings of thousands of runs are not worth printing
+    logging.getLogger().setLevel(logging.ERROR)
+
+
+def _make_machine(dp, engine):
+    if engine == "instruction":
+        return InstructionMachine(dp, microcode=_microcode)
+    if engine == "jit":
+        return ControlUnit(dp, predecoded=True, microcode=_microcode, jit=True)
+    return ControlUnit(dp, predecoded=engine == "predecoded", microcode=_microcode)
+
+
+def run_case(case, engine="predecoded", tick_limit=TICK_LIMIT, cache=None, fetch=None, memory=None):
+    start = time.perf_counter()
+    result = {"name": case.get("name", case["program"]), "program": case["program"], "input": case["input"]}
+    try:
+        dp = load_data_path(case["program"], case["input"], memory=memory)
+        if cache is not None:
+            dp.cache = Cache(**cache)
+        if fetch is not None:
+            dp.fetch = FetchUnit(**fetch)
+        machine = _make_machine(dp, engine)
+        tick_count = machine.juggernaut(tick_limit)
+    except Exception as e:
+        result.update({"halt_reason": "error", "error": f"{type(e).__name__}: {e}"})
+    else:
+        result.update(
+            {
+                "output": dp.output_buffer,
+                "ports": [dp.ports[0]["out"], dp.ports[1]["out"]],
+                "tick_count": tick_count,
+                "cmd_count": machine.cmd_count,
+                "halt_reason": machine.halt_reason,
+            }
+        )
+        if dp.cache is not None:
+            result["cache"] = dp.cache.stats
+        if dp.fetch is not None:
+            result["fetch"] = dp.fetch.stats
+    result["wall_time"] = time.perf_counter() - start
+    return result
+
+
+def _run_case_star(args):
+    return run_case(*args)
+
+
+def run_program_cases(cases, tick_limit=TICK_LIMIT, memory=None):
+    """
+    Run cases of the same program on SimdMachine; wall time is split evenly between them.
+    SimdMachine takes the memory sizes of `memory`, it has no word width.
+    """
+    sizes = {name: value for name, value in (memory or {}).items() if name != "word_bits"}
+    start = time.perf_counter()
+    results = [{"name": i.get("name", i["program"]), "program": i["program"], "input": i["input"]} for i in cases]
+    try:
+        input_texts = list()
+        for case in cases:
+            with open(case["input"]) as f:
+                input_texts.append(f.read())
+        machine = SimdMachine(cases[0]["program"], input_texts, microcode=_microcode, **sizes)
+        machine.juggernaut(tick_limit)
+    except Exception as e:
+        for result in results:
+            result.update({"halt_reason": "error", "error": f"{type(e).__name__}: {e}"})
+    else:
+        for result, lane_result in zip(results, machine.results()):
+            result.update(lane_result)
+    wall_time = (time.perf_counter() - start) / len(cases)
+    for result in results:
+        result["wall_time"] = wall_time
+    return results
+
+
+def _run_simd(pool, cases, tick_limit, memory):
+    by_program = dict()
+    for i, case in enumerate(cases):
+        by_program.setdefault(case["program"], list()).append(i)
+
+    groups = list(by_program.values())
+    results = [None] * len(cases)
+    group_results = pool.map(
+        run_program_cases,
+        [[cases[i] for i in group] for group in groups],
+        [tick_limit] * len(groups),
+        [memory] * len(groups),
+    )
+    for group, group_result in zip(groups, group_results):
+        for i, result in zip(group, group_result):
+            results[i] = result
+    return results
+
+
+def load_manifest(manifest_name):
+    with open(manifest_name) as f:
+        cases = json.load(f)
+
+    base = Path(manifest_name).resolve().parent
+    for case in cases:
+        case["program"] = os.path.join(base, case["program"])
+        case["input"] = os.path.join(base, case["input"])
+    return cases
+
+
+def run_batch(
+    cases,
+    engine="predecoded",
+    workers=None,
+    chunksize=8,
+    tick_limit=TICK_LIMIT,
+    cache=None,
+    fetch=None,
+    merge_microcode=False,
+    memory=None,
+):
+    """
+    Results of `cases` in their order. The run options (tick limit, data cache, fetch unit and `memory`, a dict
+    of DataPath memory parameters, see memory_config) apply to every case.
+    """
+    microcode = generate_mc(merge=merge_microcode)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(microcode,)) as pool:
+        if engine == "simd":
+            return _run_simd(pool, cases, tick_limit, memory)
+        tasks = [(case, engine, tick_limit, cache, fetch, memory) for case in cases]
+        return list(pool.map(_run_case_star, tasks, chunksize=chunksize))
+
+
+def main(
+    manifest_name,
+    results_name,
+    engine="predecoded",
+    workers=None,
+    tick_limit=TICK_LIMIT,
+    cache=None,
+    fetch=None,
+    merge_microcode=False,
+    memory=None,
+):
+    cases = load_manifest(manifest_name)
+
+    start = time.perf_counter()
+    results = run_batch(
+        cases,
+        engine,
+        workers,
+        tick_limit=tick_limit,
+        cache=cache,
+        fetch=fetch,
+        merge_microcode=merge_microcode,
+        memory=memory,
+    )
+    wall_time = time.perf_counter() - start
+
+    with open(results_name, "w") as f:
+        json.dump(
+            {
+                "engine": engine,
+                "cache": cache,
+                "fetch": fetch,
+                "merge_microcode": merge_microcode,
+                "memory": memory,
+                "wall_time": wall_time,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+    failed = sum(1 for i in results if i["halt_reason"] in ["error", "tick_limit"])
+    print(f"Cases: {len(results)}, failed: {failed}, wall time: {wall_time:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many programs and inputs on a process pool")
+    parser.add_argument("manifest_file")
+    parser.add_argument("results_file")
+    parser.add_argument("--engine", choices=ENGINES, default="predecoded")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--tick-limit", type=int, default=TICK_LIMIT)
+    add_memory_arguments(parser)
+    add_cache_arguments(parser)
+    add_fetch_arguments(parser)
+    parser.add_argument("--merge-microcode", action="store_true", help="merge independent microsteps into one tick")
+    args = parser.parse_args()
+    if args.engine in ["instruction", "simd"] and args.cache_size is not None:
+        parser.error(f"the {args.engine} engine has no data cache model")
+    if args.engine == "simd" and args.word_bits is not None:
+        parser.error("the simd engine has no word width model")
+    if args.engine in ["instruction", "simd"] and fetch_config(args) is not None:
+        parser.error(f"the {args.engine} engine has no instruction fetch model")
+    main(
+        args.manifest_file,
+        args.results_file,
+        args.engine,
+        args.workers,
+        args.tick_limit,
+        cache_config(args),
+        fetch_config(args),
+        args.merge_microcode,
+        memory_config(args),
+    )
@@ -0,0 +1,283 @@
+"""
+Throughput benchmark of the translator and the simulator.
+
+Every workload (the golden programs and synthetic ones scaled by `--scale`) is
+translated with `translator.main`, loaded with `DataPath.load_program` and run
+by the selected engine. Reported per workload: translation, loading and
+startup time (translation, loading and machine construction), simulated ticks
+and instructions per wall second, and peak traced memory of a separate run.
+Microcode generation is timed separately: compiling, loading the disk cache and
+taking the in-process cache.
+
+Times are the best of `--repeat` runs. `--save` writes the results as a JSON
+baseline, `--compare` checks them against a baseline and exits with status 1 if
+a metric got worse by more than `--threshold`.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import mc_generator
+import translator
+from control_unit import ControlUnit, load_data_path
+from fast_machine import InstructionMachine
+from ruamel.yaml import YAML
+
+TICK_LIMIT = 10**9
+
+ENGINES = {
+    "microcode": lambda dp: ControlUnit(dp),
+    "predecoded": lambda dp: ControlUnit(dp, predecoded=True),
+    "instruction": lambda dp: InstructionMachine(dp),
+    "jit": lambda dp: ControlUnit(dp, predecoded=True, jit=True),
+}
+
+# metric -> True if bigger is better
+METRICS = {
+    "translate_time": False,
+    "load_time": False,
+    "startup_time": False,
+    "ticks_per_second": True,
+    "instr_per_second": True,
+    "peak_memory": False,
+}
+
+# the in-process cache takes microseconds, too little to compare
+MC_METRICS = ["compile_time", "disk_cache_time"]
+
+
+GOLDEN_DIR = Path(__file__).resolve().parent / "golden"
+
+
+def golden_workloads(pattern="*.yml"):
+    workloads = dict()
+    yaml = YAML(typ="safe")
+    for path in sorted(GOLDEN_DIR.glob(pattern)):
+        with open(path, encoding="utf-8") as f:
+            golden = yaml.load(f)
+        workloads[path.stem] = (golden["in_source"], golden["in_stdin"])
+    return workloads
+
+
+def synthetic_workloads(scale=1):
+    """
+    A long counting loop, printing a long string `scale` times and `cat` of a long input
+    """
+    loop = "\n".join(
+        [
+            "section .data",
+            f"    counter: 0x{1000 * scale}",
+            "section .code",
+            "loop: load counter",
+            "    dec",
+            "    store counter",
+            "    jmpz end",
+            "    jmp loop",
+            "end: hlt",
+        ]
+    )
+    # the string has to fit into the data memory, so it is printed `scale` times
+    text = ("The quick brown fox jumps over the lazy dog " * 3)[:100]
+    string = "\n".join(
+        [
+            "section .data",
+            f'    string: "{text}"',
+            "    left: 0x0",
+            "    pose: 0x0",
+            f"    rounds: 0x{scale}",
+            "section .code",
+            "round: load &string",
+            "    store pose",
+            "    load (pose)",
+            "    store left",
+            "print: load pose",
+            "    inc",
+            "    store pose",
+            "    load (pose)",
+            "    output",
+            "    load left",
+            "    dec",
+            "    store left",
+            "    jmpz next",
+            "    jmp print",
+            "next: load rounds",
+            "    dec",
+            "    store rounds",
+            "    jmpz end",
+            "    jmp round",
+            "end: hlt",
+        ]
+    )
+    cat = "\n".join(["section .code", "start: input", "    output", "    jmp start"])
+    return {
+        f"loop_x{scale}": (loop, ""),
+        f"string_x{scale}": (string, ""),
+        f"cat_x{scale}": (cat, "abcdefghij" * 100 * scale),
+    }
+
+
+def _best(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+
+def bench_workload(source, input_text, engine, repeat):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_name = os.path.join(tmp_dir, "source.asm")
+        input_name = os.path.join(tmp_dir, "input.txt")
+        target = os.path.join(tmp_dir, "target.json")
+        with open(source_name, "w") as f:
+            f.write(source)
+        with open(input_name, "w") as f:
+            f.write(input_text)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            translate_time, _ = _best(lambda: translator.main(source_name, target), repeat)
+        load_time, _ = _best(lambda: load_data_path(target, input_name), repeat)
+        startup_time, _ = _best(lambda: ENGINES[engine](load_data_path(target, input_name)), repeat)
+
+        def run():
+            machine = ENGINES[engine](load_data_path(target, input_name))
+            return machine.juggernaut(TICK_LIMIT), machine.cmd_count
+
+        run_time, (ticks, commands) = _best(run, repeat)
+
+        tracemalloc.start()
+        run()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "ticks": ticks,
+        "instructions": commands,
+        "translate_time": translate_time,
+        "load_time": load_time,
+        "startup_time": translate_time + startup_time,
+        "run_time": run_time,
+        "ticks_per_second": ticks / run_time,
+        "instr_per_second": commands / run_time,
+        "peak_memory": peak_memory,
+    }
+
+
+def bench_microcode(repeat):
+    with tempfile.TemporaryDirectory() as cache_dir:
+
+        def compile_mc():
+            mc_generator._mc_cache.clear()
+            for path in Path(cache_dir).iterdir():
+                path.unlink()
+            return mc_generator.generate_mc(cache_dir)
+
+        def load_disk_cache():
+            mc_generator._mc_cache.clear()
+            return mc_generator.generate_mc(cache_dir)
+
+        compile_time, _ = _best(compile_mc, repeat)
+        disk_cache_time, _ = _best(load_disk_cache, repeat)
+        process_cache_time, _ = _best(lambda: mc_generator.generate_mc(cache_dir), repeat)
+    return {
+        "compile_time": compile_time,
+        "disk_cache_time": disk_cache_time,
+        "process_cache_time": process_cache_time,
+    }
+
+
+def run_benchmark(workloads, engine="predecoded", repeat=3):
+    # an empty input ends most programs, its warnings are not interesting here
+    logging.getLogger().setLevel(logging.ERROR)
+    results = {name: bench_workload(source, stdin, engine, repeat) for name, (source, stdin) in workloads.items()}
+    return {
+        "python": sys.version.split()[0],
+        "machine": platform.machine(),
+        "engine": engine,
+        "microcode": bench_microcode(repeat),
+        "workloads": results,
+    }
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Regressions against `baseline`: (name, metric, baseline value, new value)
+    """
+    regressions = list()
+    pairs = [("microcode", metric, False) for metric in MC_METRICS]
+    pairs += [(name, metric, bigger) for name in results["workloads"] for metric, bigger in METRICS.items()]
+    for name, metric, bigger_is_better in pairs:
+        new_section = results["microcode"] if name == "microcode" else results["workloads"][name]
+        old_section = baseline["microcode"] if name == "microcode" else baseline["workloads"].get(name)
+        if old_section is None or metric not in old_section:
+            continue
+        old, new = old_section[metric], new_section[metric]
+        if old <= 0:
+            continue
+        change = (old - new) / old if bigger_is_better else (new - old) / old
+        if change > threshold:
+            regressions.append((name, metric, old, new))
+    return regressions
+
+
+def print_results(results):
+    print(f"Engine: {results['engine']}, Python {results['python']}")
+    mc = results["microcode"]
+    print(
+        f"Microcode: compile {mc['compile_time'] * 1e3:.2f} ms, disk cache {mc['disk_cache_time'] * 1e3:.2f} ms, "
+        f"process cache {mc['process_cache_time'] * 1e6:.1f} us"
+    )
+    header = f"{'workload':<16} {'ticks':>9} {'instr':>8} {'startup':>10} {'ticks/s':>11} {'instr/s':>10} {'peak':>9}"
+    print(header)
+    for name, res in results["workloads"].items():
+        print(
+            f"{name:<16} {res['ticks']:>9} {res['instructions']:>8} {res['startup_time'] * 1e3:>7.2f} ms "
+            f"{res['ticks_per_second']:>11.0f} {res['instr_per_second']:>10.0f} {res['peak_memory'] / 1024:>6.0f} KB"
+        )
+
+
+def main(engine="predecoded", scale=1, repeat=3, save=None, baseline_name=None, threshold=0.1):
+    workloads = golden_workloads()
+    workloads.update(synthetic_workloads(scale))
+    results = run_benchmark(workloads, engine, repeat)
+    print_results(results)
+
+    if save is not None:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline_name is None:
+        return 0
+    with open(baseline_name) as f:
+        baseline = json.load(f)
+    if baseline["engine"] != engine:
+        print(f"Warning: the baseline was measured with the {baseline['engine']} engine")
+    regressions = compare(results, baseline, threshold)
+    for name, metric, old, new in regressions:
+        print(f"REGRESSION {name} {metric}: {old:.6g} -> {new:.6g}")
+    print(f"Compared with {baseline_name}: {len(regressions)} regressions over {threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the translator and the simulator")
+    parser.add_argument("--engine", choices=list(ENGINES), default="predecoded")
+    parser.add_argument("--scale", type=int, default=1, help="size factor of the synthetic workloads")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best one is taken")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare with a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported as a regression")
+    args = parser.parse_args()
+    sys.exit(main(args.engine, args.scale, args.repeat, args.save, args.compare, args.threshold))
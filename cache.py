@@ -0,0 +1,136 @@
+"""
+Data cache model.
+
+The cache sits in front of `DataPath.data_mem` and only models latency: values
+are always read from and written to data_mem, the cache keeps which lines it
+holds and reports how many ticks each access stalls the machine.
+
+Every memory transaction (filling a line, writing back a dirty line, writing a
+word through) costs `memory_latency` ticks; hits are free.
+"""
+
+import random
+from collections import OrderedDict
+
+WRITE_POLICIES = ["back", "through"]
+REPLACEMENTS = ["lru", "fifo", "random"]
+
+STAT_NAMES = ["reads", "writes", "hits", "misses", "evictions", "writebacks", "stall_ticks"]
+
+
+class CacheConfigError(Exception):
+    def __init__(self, size, line_size, ways):
+        super().__init__(f"Cache size {size} is not a multiple of line size {line_size} * {ways} ways")
+
+
+class Cache:
+    """
+    Set-associative cache. Write-back caches allocate lines on write misses,
+    write-through ones do not.
+    """
+
+    def __init__(self, size=64, line_size=4, ways=2, write_policy="back", replacement="lru", memory_latency=10, seed=0):
+        if size <= 0 or line_size <= 0 or ways <= 0 or size % (line_size * ways) != 0:
+            raise CacheConfigError(size, line_size, ways)
+        self.size = size
+        self.line_size = line_size
+        self.ways = ways
+        self.write_back = write_policy == "back"
+        self.replacement = replacement
+        self.memory_latency = memory_latency
+        self.random = random.Random(seed)
+
+        # line number -> dirty flag, in the order of replacement
+        self.sets = [OrderedDict() for _ in range(size // line_size // ways)]
+        self.stats = dict.fromkeys(STAT_NAMES, 0)
+
+    def access(self, addr, write=False):
+        """
+        Register an access and return the number of stall ticks
+        """
+        stats = self.stats
+        stats["writes" if write else "reads"] += 1
+        line = addr // self.line_size
+        lines = self.sets[line % len(self.sets)]
+
+        if line in lines:
+            stats["hits"] += 1
+            if self.replacement == "lru":
+                lines.move_to_end(line)
+            stall = 0
+            if write and self.write_back:
+                lines[line] = True
+            elif write:
+                stall = self.memory_latency
+        else:
+            stats["misses"] += 1
+            stall = self.memory_latency
+            if not write or self.write_back:
+                stall += self._evict(lines)
+                lines[line] = write
+
+        stats["stall_ticks"] += stall
+        return stall
+
+    def _evict(self, lines):
+        if len(lines) < self.ways:
+            return 0
+        if self.replacement == "random":
+            victim = self.random.choice(list(lines))
+            dirty = lines.pop(victim)
+        else:
+            _, dirty = lines.popitem(last=False)
+
+        self.stats["evictions"] += 1
+        if dirty:
+            self.stats["writebacks"] += 1
+            return self.memory_latency
+        return 0
+
+    def snoop(self, addr, write):
+        """
+        Another cache of a coherent bus accesses `addr`: the line is dropped on its write.
+        Returns (held, dirty): whether the line was held and had to be written back first.
+        """
+        line = addr // self.line_size
+        lines = self.sets[line % len(self.sets)]
+        if line not in lines:
+            return False, False
+        dirty = lines[line]
+        if write:
+            del lines[line]
+        else:
+            lines[line] = False
+        return True, dirty
+
+    def report(self):
+        accesses = self.stats["reads"] + self.stats["writes"]
+        hit_rate = self.stats["hits"] / accesses if accesses else 0
+        counters = ", ".join(f"{name}: {self.stats[name]}" for name in STAT_NAMES)
+        return f"Cache {self.size}/{self.line_size}/{self.ways}: {counters}, hit rate: {hit_rate:.3f}"
+
+
+def add_cache_arguments(parser):
+    group = parser.add_argument_group("data cache")
+    group.add_argument("--cache-size", type=int, help="enable the data cache of this many words")
+    group.add_argument("--cache-line", type=int, default=4, help="words per line")
+    group.add_argument("--cache-ways", type=int, default=2, help="associativity")
+    group.add_argument("--write-policy", choices=WRITE_POLICIES, default="back")
+    group.add_argument("--replacement", choices=REPLACEMENTS, default="lru")
+    group.add_argument("--memory-latency", type=int, default=10, help="ticks of one memory transaction")
+
+
+def cache_config(args):
+    """
+    Cache parameters from parsed arguments, or None when the cache is disabled
+    """
+    if args.cache_size is None:
+        return None
+    return {
+        "size": args.cache_size,
+        "line_size": args.cache_line,
+        "ways": args.cache_ways,
+        "write_policy": args.write_policy,
+        "replacement": args.replacement,
+        "memory_latency": args.memory_latency,
+    }
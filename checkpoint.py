@@ -0,0 +1,39 @@
+"""
+Checkpoints of a running machine.
+
+A checkpoint keeps the whole DataPath (registers, multiplexers, signals_dict,
+memories and I/O buffers) and the ControlUnit registers, pickled and
+compressed with zlib. Only load checkpoints you have written yourself:
+unpickling runs arbitrary code.
+"""
+
+import pickle
+import zlib
+
+MAGIC = b"ZACP"
+VERSION = 1
+
+
+class InvalidCheckpointError(Exception):
+    def __init__(self, filename):
+        super().__init__(f'Not a version {VERSION} checkpoint: "{filename}"')
+
+
+def save_checkpoint(filename, dp, cu_state):
+    payload = zlib.compress(pickle.dumps({"dp": dp, "cu": cu_state}, protocol=pickle.HIGHEST_PROTOCOL))
+    with open(filename, "wb") as f:
+        f.write(MAGIC + VERSION.to_bytes(2, "little") + payload)
+
+
+def load_checkpoint(filename):
+    """
+    Return the saved DataPath and ControlUnit state, see ControlUnit.restore
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    header_size = len(MAGIC) + 2
+    if data[: len(MAGIC)] != MAGIC or int.from_bytes(data[len(MAGIC) : header_size], "little") != VERSION:
+        raise InvalidCheckpointError(filename)
+
+    state = pickle.loads(zlib.decompress(data[header_size:]))
+    return state["dp"], state["cu"]
@@ -1,17 +1,54 @@
+import argparse
+import contextlib
 import logging
 import sys
-
-from data_path import DataPath, EmptyBufferError, HltError
+from collections import deque
+from itertools import chain
+
+from cache import Cache, add_cache_arguments, cache_config
+from checkpoint import load_checkpoint, save_checkpoint
+from data_path import (
+    DATA_MEM_SIZE,
+    INSTRUCT_MEM_SIZE,
+    DataPath,
+    EmptyBufferError,
+    HltError,
+    WaitError,
+    add_memory_arguments,
+    memory_config,
+    render_value,
+)
+from exec_trace import TraceRecorder
+from fetch import FetchUnit, add_fetch_arguments, fetch_config
+from interrupts import InterruptController, load_schedule
 from isa import code_to_operation
-from mc_generator import generate_mc
+from jit import TraceJit
+from mc_consts import MUX_LIST, bit_dict
+from mc_generator import generate_mc, rom_digest
+from profiler import Profiler, program_terms
+from streams import InputStream, decode_input
+from tracing import debug_enabled, start_trace, stop_trace
 
 
 class TickLimitError(Exception):
     pass
 
 
+class CheckpointError(Exception):
+    def __init__(self):
+        super().__init__("Can't resume from checkpoint: microcode ROM has changed")
+
+
+class StreamCheckpointError(Exception):
+    def __init__(self):
+        super().__init__("Can't save a checkpoint with --stream-input or --stream-output: the streams are open files")
+
+
 TICK_LIMIT = 5e4
 
+# ControlUnit registers saved in a checkpoint; current_instr is fetched again from reg_ip
+STATE_FIELDS = ["reg_ip", "mux", "jmp", "cmd_count", "tick", "halt_reason"]
+
 
 class ControlUnit:
     mc_mem = None
@@ -23,13 +60,26 @@ class ControlUnit:
     current_instr = None
     bits_func = None
     decode_dict = None
-
-    def __init__(self, dp: DataPath, need_log=False):
+    mc_ops = None
+    current_ops = None
+
+    def __init__(self, dp: DataPath, need_log=False, predecoded=False, microcode=None, observers=(), jit=False):
+        """
+        `observers` get `record_reset(dp, tick)`, `record(tick, mc_ip, dp)` after every tick
+        and `stop(halt_reason, mc_ip)`: see TraceRecorder and Profiler.
+        `jit` runs hot loops with compiled traces (see jit.py) when there is nothing to observe per tick.
+        The interrupt controller of the DataPath, if any, is an observer too.
+        """
         self.jmp = None
         self.need_log = need_log
+        self.predecoded = predecoded
+        self.observers = self._with_interrupts(dp, observers)
         self.dp = dp
+        self.halt_reason = None
+        self.tick = 0
 
         self.mc_mem = []
+        self.mc_ops = []
         self.reg_ip = 0
         self.current_instr = None
         self.decode_dict = {}
@@ -56,21 +106,33 @@ class ControlUnit:
             self.get_mc_instruction_signal,
             dp.port_1_signal,
             dp.port_2_signal,
+            dp.interrupt_control_signal,
         ]
 
-        self.load_mem()
+        self.load_mem(microcode)
+        self.jit = TraceJit(dp, self.mc_mem, self.decode_dict) if jit else None
 
         self.set_mux(0)
         self.latch_ip()
         self.get_mc_instruction_signal()
 
+        for observer in self.observers:
+            observer.record_reset(dp)
+
+    @staticmethod
+    def _with_interrupts(dp, observers):
+        observers = list(observers)
+        if dp.interrupts is not None:
+            observers.append(dp.interrupts)
+        return observers
+
     def set_jmp_mux(self, signal):
         self.jmp = signal
 
     def set_mux(self, signal):
         self.mux = signal
 
-        if signal == 0 and self.need_log:
+        if signal == 0 and self.need_log and debug_enabled():
             self.log_state()
 
     def latch_ip(self, signal=1):
@@ -88,22 +150,68 @@ class ControlUnit:
         if s == 0:
             return
         self.current_instr = self.mc_mem[self.reg_ip]
-
-    def juggernaut(self):
-        tick = 0
+        if self.predecoded:
+            self.current_ops = self.mc_ops[self.reg_ip]
+
+    def juggernaut(self, tick_limit=TICK_LIMIT):  # noqa: C901
+        """
+        Run until the machine stops or `tick_limit` is exceeded.
+        Continues from the current tick, so a stopped run can be resumed with a larger limit.
+        """
+        execute = self.execute_predecoded if self.predecoded else self.execute
+        observers = self.observers
+        dp = self.dp
+        jit = self._active_jit()
+        tick = self.tick
+        self.halt_reason = None
         while True:
+            mc_ip = self.reg_ip
             try:
-                self.execute()
+                if jit is not None and mc_ip == 0:
+                    tick = jit.run(self, tick, tick_limit)
+                execute()
                 tick += 1
             except HltError:
+                self.halt_reason = "hlt"
                 break
             except EmptyBufferError:
+                self.halt_reason = "empty_buffer"
                 break
+            except WaitError:
+                # nothing changes until the next input arrives: the waiting ticks pass at once,
+                # then the microinstruction runs again
+                tick = dp.interrupts.skip_wait(tick + 1, tick_limit)
+
+            if dp.stall:
+                # the microinstruction waits for the data cache or is overlapped by the fetch unit
+                tick += dp.stall
+                dp.stall = 0
+
+            for observer in observers:
+                observer.record(tick, mc_ip, dp)
 
-            if tick > TICK_LIMIT:
+            if tick > tick_limit:
                 logging.error("Tick limit exceeded")
-                return -1
-        return tick
+                self.halt_reason = "tick_limit"
+                break
+
+        self.tick = tick
+        for observer in observers:
+            observer.stop(self.halt_reason, self.reg_ip)
+        return -1 if self.halt_reason == "tick_limit" else tick
+
+    def _active_jit(self):
+        """
+        Compiled traces skip ticks, so they are not used while ticks are observed, logged or changed by the cache
+        or the fetch unit; they compute with unbounded words
+        """
+        if self.observers or self.dp.cache is not None or self.dp.fetch is not None:
+            return None
+        if self.need_log and debug_enabled():
+            return None
+        if self.dp.word_bits is not None:
+            return None
+        return self.jit
 
     def execute(self):
         cmd = self.current_instr
@@ -112,66 +220,242 @@ class ControlUnit:
             #     pass
             func(bit)
 
+    def execute_predecoded(self):
+        for func, bit in self.current_ops:
+            func(bit)
+
     def decode(self):
         return self.decode_dict[self.dp.reg_ir]
 
-    def load_mem(self):
-        self.mc_mem, self.decode_dict = generate_mc()
+    def load_mem(self, microcode=None):
+        """
+        Load the microcode ROM; `microcode` is an already generated (mc_mem, decode_dict) pair
+        """
+        self.mc_mem, self.decode_dict = generate_mc() if microcode is None else microcode
+        if self.predecoded:
+            self.mc_ops = [self._predecode(line) for line in self.mc_mem]
+
+    def _predecode(self, line):
+        """
+        Keep only the handlers which do something on this microinstruction:
+        active strobes and every multiplexer selector, in the original bit order.
+        """
+        mux_bits = {bit_dict[name] for name in MUX_LIST}
+        return [(func, bit) for i, (bit, func) in enumerate(zip(line, self.bits_func)) if bit != 0 or i in mux_bits]
+
+    def get_state(self):
+        state = {name: getattr(self, name) for name in STATE_FIELDS}
+        state["rom"] = rom_digest(self.mc_mem)
+        return state
+
+    def set_state(self, state):
+        if state["rom"] != rom_digest(self.mc_mem):
+            raise CheckpointError()
+        for name in STATE_FIELDS:
+            setattr(self, name, state[name])
+        self.get_mc_instruction_signal()
+
+    @classmethod
+    def restore(cls, dp, state, need_log=False, predecoded=False, microcode=None, observers=(), jit=False):
+        """
+        ControlUnit continuing from a saved state of itself and its DataPath
+        """
+        cu = cls(dp, False, predecoded, microcode, jit=jit)
+        cu.set_state(state)
+        cu.need_log = need_log
+        cu.observers = cls._with_interrupts(dp, observers)
+        for observer in cu.observers:
+            observer.record_reset(dp, cu.tick)
+        return cu
 
     def log_state(self):
         cmd, addr = (i.name for i in code_to_operation(self.dp.reg_ir))
+        flags = f"Z: {self.dp.flag_z}; "
+        if self.dp.word_bits is not None:
+            flags += f"C: {self.dp.flag_c}; V: {self.dp.flag_v}; "
         logging.debug(
-            f"IP: {self.dp.reg_ip}; "
-            f"IR: cmd: {cmd}, addr {addr}; "
-            f"ADDR: {self.dp.reg_addr}; "
-            f"Z: {self.dp.flag_z}; "
-            f"ACC: {self.dp.acc}"
+            f"IP: {self.dp.reg_ip}; IR: cmd: {cmd}, addr {addr}; ADDR: {self.dp.reg_addr}; {flags}ACC: {self.dp.acc}"
         )
 
 
-def get_input_list(input_text):
-    res_list = list()
-    for input_text in input_text.split():
-        res = list()
-        for i in list(input_text):
-            if i.isdigit():
-                res.append(int(i))
-            else:
-                res.append(ord(i))
-        res_list.append(res)
+def load_data_path(scr_name, input_name, input_stream=None, memory=None):
+    """
+    With `input_stream` (an open text file) the input buffer reads it lazily
+    and `input_name` is not used; the ports get no input.
+    `memory` is a dict of DataPath memory parameters (sizes and word width), see memory_config.
+    """
+    if input_stream is None:
+        with open(input_name) as input_name:
+            input_b, port1_b, port2_b = decode_input(input_name.read())
+    else:
+        input_b, port1_b, port2_b = InputStream(input_stream), deque(), deque()
+
+    memory = dict(memory or {})
+    memory.setdefault("data_mem_size", DATA_MEM_SIZE)
+    memory.setdefault("instruct_mem_size", INSTRUCT_MEM_SIZE)
+    dp = DataPath(input_buffer=input_b, **memory)
+    dp.load_program(scr_name)
 
-    while len(res_list) < 3:
-        res_list.append([])
+    dp.ports[0]["in"] = port1_b
+    dp.ports[1]["in"] = port2_b
 
-    return res_list
+    return dp
 
 
-def main(scr_name, input_name):
-    with open(input_name) as input_name:
-        input_b, port1_b, port2_b = get_input_list(input_name.read())
+def open_input_stream(input_name):
+    if input_name == "-":
+        return contextlib.nullcontext(sys.stdin)
+    return open(input_name, encoding="utf-8")
 
-    dp = DataPath(128, 128, input_b)
-    dp.load_program(scr_name)
 
-    dp.ports[0]["in"] = port1_b
-    dp.ports[1]["in"] = port2_b
+def print_result(dp, tick_count, cmd_count):
+    # streamed outputs are already written and iterate as empty
+    for i in chain(dp.output_buffer, dp.ports[0]["out"], dp.ports[1]["out"]):
+        print(render_value(i), end="")
 
-    cu = ControlUnit(dp, True)
+    print(f"\n\nTick count: {tick_count}, Command count: {cmd_count}")
 
-    tick_count = cu.juggernaut()
-    cmd_count = cu.cmd_count
 
-    output = cu.dp.output_buffer + cu.dp.ports[0]["out"] + cu.dp.ports[1]["out"]
+def _setup_data_path(
+    stack, scr_name, input_name, stream_input, stream_output, port_files, cache, memory, fetch, schedule
+):
+    input_stream = stack.enter_context(open_input_stream(input_name)) if stream_input else None
+    dp = load_data_path(scr_name, input_name, input_stream, memory)
+    if stream_output:
+        port_files = [None if i is None else stack.enter_context(open(i, "w")) for i in port_files]
+        dp.stream_output(sys.stdout, port_files)
+    if cache is not None:
+        dp.cache = Cache(**cache)
+    if fetch is not None:
+        dp.fetch = FetchUnit(**fetch)
+    if schedule is not None:
+        InterruptController(load_schedule(schedule)).install(dp)
+    return dp
+
+
+def _print_reports(dp, tick_count, cmd_count):
+    if dp.cache is not None:
+        print(dp.cache.report())
+    if dp.fetch is not None:
+        print(dp.fetch.report(tick_count, cmd_count))
+    if dp.interrupts is not None:
+        print(dp.interrupts.report(tick_count))
+
+
+def _setup_observers(stack, dp, record_file, profile, microcode):
+    observers = list()
+    if record_file is not None:
+        observers.append(stack.enter_context(contextlib.closing(TraceRecorder(record_file))))
+    profiler = None
+    if profile is not None:
+        profiler = Profiler(microcode[0], dp.instruct_mem_size)
+        observers.append(profiler)
+    return observers, profiler
+
+
+def main(
+    scr_name,
+    input_name,
+    predecoded=False,
+    trace_file=None,
+    record_file=None,
+    tick_limit=TICK_LIMIT,
+    checkpoint_file=None,
+    resume_file=None,
+    stream_input=False,
+    stream_output=False,
+    port_files=(None, None),
+    cache=None,
+    profile=None,
+    jit=False,
+    memory=None,
+    fetch=None,
+    merge_microcode=False,
+    schedule=None,
+):
+    """
+    `cache` is a dict of Cache parameters, the data cache is disabled without it.
+    `profile` is the number of hot lines in the profiler report, no profiling without it.
+    `memory` sets the memory sizes and the data word width, see memory_config; words are unbounded by default.
+    `fetch` is a dict of FetchUnit parameters, instruction fetch is not modelled without it.
+    `merge_microcode` runs the ROM with independent microsteps merged, see mc_optimizer.py.
+    `schedule` is a file of timed port input, it enables the interrupt controller (see interrupts.py).
+    """
+    if checkpoint_file is not None and (stream_input or stream_output):
+        raise StreamCheckpointError()
+    microcode = generate_mc(merge=merge_microcode)
+    with contextlib.ExitStack() as stack:
+        if trace_file is not None:
+            stack.callback(stop_trace, start_trace(trace_file))
+
+        state = None
+        if resume_file is None:
+            dp = _setup_data_path(
+                stack, scr_name, input_name, stream_input, stream_output, port_files, cache, memory, fetch, schedule
+            )
+        else:
+            dp, state = load_checkpoint(resume_file)
+        observers, profiler = _setup_observers(stack, dp, record_file, profile, microcode)
 
-    for i in output:
-        if ord(" ") <= i <= ord("z") or i == ord("\n"):
-            print(chr(i), end="")
+        if state is None:
+            cu = ControlUnit(dp, True, predecoded, microcode, observers, jit)
         else:
-            print(i, end="")
+            cu = ControlUnit.restore(dp, state, True, predecoded, microcode, observers, jit)
 
-    print(f"\n\nTick count: {tick_count}, Command count: {cmd_count}")
+        tick_count = cu.juggernaut(tick_limit)
+
+    if checkpoint_file is not None:
+        save_checkpoint(checkpoint_file, dp, cu.get_state())
+
+    print_result(dp, tick_count, cu.cmd_count)
+    _print_reports(dp, tick_count, cu.cmd_count)
+    if profiler is not None:
+        terms = None if scr_name is None else program_terms(scr_name)
+        print(profiler.report(dp.instr_codes, dp.instr_args, terms, profile), end="")
 
 
 if __name__ == "__main__":
-    source_file, input_file = sys.argv[1:]
-    main(source_file, input_file)
+    parser = argparse.ArgumentParser(description="Microcoded machine model")
+    parser.add_argument("source_file", nargs="?")
+    parser.add_argument("input_file", nargs="?")
+    parser.add_argument("--predecoded", action="store_true", help="run only active microinstruction signals")
+    parser.add_argument("--trace", metavar="FILE", help="write the debug journal to a buffered file")
+    parser.add_argument("--record", metavar="FILE", help="write a binary execution trace, see exec_trace.py")
+    parser.add_argument("--tick-limit", type=int, default=TICK_LIMIT, help="stop after this many ticks")
+    parser.add_argument("--checkpoint", metavar="FILE", help="save the machine state when the run stops")
+    parser.add_argument("--resume", metavar="FILE", help="continue from a saved checkpoint instead of a program")
+    parser.add_argument("--stream-input", action="store_true", help="read input_file ('-' for stdin) while running")
+    parser.add_argument("--stream-output", action="store_true", help="write output to stdout while running")
+    parser.add_argument("--port-files", nargs=2, metavar="FILE", default=(None, None), help="stream output ports too")
+    parser.add_argument("--jit", action="store_true", help="compile hot loops into Python functions")
+    parser.add_argument("--profile", nargs="?", type=int, const=10, metavar="TOP", help="print a hot-spot report")
+    add_memory_arguments(parser)
+    add_cache_arguments(parser)
+    add_fetch_arguments(parser)
+    parser.add_argument("--merge-microcode", action="store_true", help="merge independent microsteps into one tick")
+    parser.add_argument("--port-schedule", metavar="FILE", help="timed port input, enables interrupts")
+    args = parser.parse_args()
+    if args.resume is None and (args.source_file is None or args.input_file is None):
+        parser.error("source_file and input_file are required unless --resume is given")
+    if args.checkpoint is not None and (args.stream_input or args.stream_output):
+        parser.error("--checkpoint can't be combined with --stream-input or --stream-output")
+    main(
+        args.source_file,
+        args.input_file,
+        args.predecoded,
+        args.trace,
+        args.record,
+        args.tick_limit,
+        args.checkpoint,
+        args.resume,
+        args.stream_input,
+        args.stream_output,
+        args.port_files,
+        cache_config(args),
+        args.profile,
+        args.jit,
+        memory_config(args),
+        fetch_config(args),
+        args.merge_microcode,
+        args.port_schedule,
+    )
@@ -1,18 +1,112 @@
 import json
 import logging
+from array import array
+from collections import deque
 
-from isa import Opcode, code_to_operation, operation_to_code
+from isa import Address, Opcode, code_table, code_to_operation, operation_to_code
+from machine_code import _to_word, data_to_mem, is_binary, read_binary
+from mc_consts import INT_CTL_VALUES
+from streams import OutputStream
+from tracing import debug_enabled
+
+# Unused instruction memory is filled with `hlt`, so running past the program stops the machine
+HLT_CODE = operation_to_code(Opcode.HLT, Address.NO_OP)
+
+# The decoder puts it in place of the fetched instruction to enter an interrupt
+INT_CODE = operation_to_code(Opcode.INT, Address.NO_OP)
+
+
+# Array type codes of signed data words by word width
+WORD_TYPECODES = {8: "b", 16: "h", 32: "i", 64: "q"}
+
+DATA_MEM_SIZE = 128
+INSTRUCT_MEM_SIZE = 128
+
+# Address types whose argument is a data memory address
+DATA_ADDRESSING = [Address.LABEL_VAL, Address.LABEL_ADDR, Address.INDIRECT]
 
 
 class HltError(Exception):
     pass
 
 
+class ProgramSizeError(Exception):
+    def __init__(self, memory, required, size):
+        super().__init__(f"Program needs {required} cells of {memory} memory, the machine has {size}")
+
+
+class AddressError(Exception):
+    def __init__(self, ip, memory, addr, size):
+        super().__init__(f"Instruction {ip} refers to {memory} address {addr} outside 0..{size - 1}")
+
+
+class MemoryAccessError(Exception):
+    def __init__(self, ip, addr):
+        super().__init__(f"Instruction {ip} accessed an address outside the memory (ADDR: {addr})")
+
+
+class WordBitsError(Exception):
+    def __init__(self, word_bits):
+        super().__init__(f"Unsupported word width {word_bits}, expected one of {list(WORD_TYPECODES)}")
+
+
 class EmptyBufferError(Exception):
     pass
 
 
+class WaitError(Exception):
+    """
+    The microinstruction waits for a scheduled input token and runs again on the next tick
+    """
+
+
+def add_memory_arguments(parser):
+    group = parser.add_argument_group("memory")
+    group.add_argument("--data-size", type=int, default=DATA_MEM_SIZE, help="data memory cells")
+    group.add_argument("--code-size", type=int, default=INSTRUCT_MEM_SIZE, help="instruction memory cells")
+    group.add_argument("--word-bits", type=int, choices=list(WORD_TYPECODES), help="wrap data words at this width")
+
+
+def memory_config(args):
+    """
+    DataPath memory parameters from parsed arguments
+    """
+    return {"data_mem_size": args.data_size, "instruct_mem_size": args.code_size, "word_bits": args.word_bits}
+
+
+def wrap_word(value, word_bits):
+    """
+    `value` as a signed word of `word_bits` bits
+    """
+    half = 1 << (word_bits - 1)
+    return ((value + half) & ((1 << word_bits) - 1)) - half
+
+
+def alu_word(instr, acc, mux, res, word_bits):
+    """
+    ALU result `res` of `instr` wrapped to a word, with the carry (borrow for subtraction)
+    and overflow flags
+    """
+    mask = (1 << word_bits) - 1
+    wrapped = wrap_word(res, word_bits)
+    if instr in [Opcode.INC, Opcode.ADD]:
+        carry = (acc & mask) + ((1 if instr == Opcode.INC else mux) & mask) > mask
+    elif instr in [Opcode.DEC, Opcode.SUB]:
+        carry = (acc & mask) < ((1 if instr == Opcode.DEC else mux) & mask)
+    elif instr == Opcode.NEG:
+        carry = acc & mask != 0
+    else:
+        carry = False
+    return wrapped, int(carry), int(wrapped != res)
+
+
 class DataPath:
+    """
+    Without `word_bits` words are unbounded Python ints kept in a list. With it data
+    memory is a typed array of signed `word_bits`-bit words, ALU results wrap around
+    and set the carry (C) and overflow (V) flags.
+    """
+
     acc = None
     reg_ip = None
     reg_ir = None
@@ -25,18 +119,26 @@ class DataPath:
     signals_dict = None
 
     data_mem = None
-    instruct_mem = None
+    instr_codes = None
+    instr_args = None
 
     data_mem_size = None
     instruct_mem_size = None
     input_buffer = None
     output_buffer = None
-
-    def __init__(self, data_mem_size, instruct_mem_size, input_buffer):
+    cache = None
+    fetch = None
+    interrupts = None
+
+    def __init__(self, data_mem_size, instruct_mem_size, input_buffer, word_bits=None):
+        if word_bits is not None and word_bits not in WORD_TYPECODES:
+            raise WordBitsError(word_bits)
+        self.word_bits = word_bits
         self.input_buffer = input_buffer
         self.output_buffer = list()
+        self.output_text = list()
 
-        self.ports = [{"in": list(), "out": list()} for i in range(2)]
+        self.ports = [{"in": deque(), "out": list()} for i in range(2)]
 
         self.instruct_mem_size = instruct_mem_size
         self.data_mem_size = data_mem_size
@@ -46,6 +148,8 @@ class DataPath:
         self.reg_ir = 0
         self.reg_addr = 0
         self.flag_z = 0
+        self.flag_c = 0
+        self.flag_v = 0
         self.mux_addr_i = 0
         self.mux_alu_i = 0
         self.mux_alu_input_i = 0
@@ -62,56 +166,93 @@ class DataPath:
             "reg_addr": self.reg_addr,
             "acc": self.acc,
             "z": self.flag_z,
+            "c": self.flag_c,
+            "v": self.flag_v,
             "ALU_instr": None,
             "data_mem_input": 0,
+            "int_return": 0,
+            "int_vector": 0,
         }
         self.data_mem = list()
-        self.instruct_mem = list()
+        # optional data cache (see cache.py) and the ticks it stalls the current microinstruction
+        self.cache = None
+        self.stall = 0
+        # optional instruction fetch model (see fetch.py), it adds to `stall` too
+        self.fetch = None
+        # optional interrupt controller of the input ports (see interrupts.py), disabled on reset
+        self.interrupts = None
+        self.interrupt_enable = 0
+        self.saved_ip = 0
+        self.instr_codes = array("H")
+        self.instr_args = array("q")
 
     def load_data_mem(self, mem_list: list):
-        self.data_mem = mem_list + [0] * (self.data_mem_size - len(mem_list))
+        if self.word_bits is None:
+            self.data_mem = mem_list + [0] * (self.data_mem_size - len(mem_list))
+            return
+        self.data_mem = array(
+            WORD_TYPECODES[self.word_bits], [wrap_word(_to_word(i), self.word_bits) for i in mem_list]
+        )
+        self.data_mem.extend([0] * (self.data_mem_size - len(mem_list)))
 
     def load_instr_mem(self, instr_list: list):
-        self.instruct_mem = instr_list + [0] * (self.instruct_mem_size - len(instr_list))
+        """
+        Encode instructions into parallel arrays of instruction codes and arguments
+        """
+        codes = [operation_to_code(i["opcode"], i["address_type"]) for i in instr_list]
+        args = [i["arg"] for i in instr_list]
+        self.load_encoded_instr_mem(codes, args)
+
+    def load_encoded_instr_mem(self, codes, args):
+        padding = self.instruct_mem_size - len(codes)
+        self.instr_codes = array("H", codes)
+        self.instr_codes.extend([HLT_CODE] * padding)
+        self.instr_args = array("q", args)
+        self.instr_args.extend([0] * padding)
 
     def get_instruction_signal(self, s):
         if s == 0:
             return
         ip_reg = self.signals_dict["reg_ip"]
-        instr = self.instruct_mem[ip_reg]
-        code = operation_to_code(instr["opcode"], instr["address_type"])
+        code = self.instr_codes[ip_reg]
+        arg = self.instr_args[ip_reg]
+        if self.fetch is not None:
+            self.stall += self.fetch.read(ip_reg)
 
         self.signals_dict["reg_ir"] = code
         self.signals_dict["ALU_instr"] = code
-        self.signals_dict["MUX_addr"][1] = instr["arg"]
-        self.signals_dict["MUX_ip"][0] = instr["arg"]
-        self.signals_dict["MUX_ALU"][0] = instr["arg"]
+        self.signals_dict["MUX_addr"][1] = arg
+        self.signals_dict["MUX_ip"][0] = arg
+        self.signals_dict["MUX_ALU"][0] = arg
 
     def _get_mux_alu_input(self):
         if self.mux_alu_input_i == 0:
             mux = self.signals_dict["MUX_ALU"][self.mux_alu_i]
         elif self.mux_alu_input_i == 1:
-            if len(self.input_buffer) == 0:
+            try:
+                mux = self.input_buffer.popleft()
+            except IndexError:
                 logging.warning("Input buffer is empty!")
-                raise EmptyBufferError()
-            mux = self.input_buffer.pop(0)
-            logging.debug(f"input: {mux}")
+                raise EmptyBufferError() from None
+            logging.debug("input: %s", mux)
 
         else:
             port_id = self.mux_alu_input_i - 2
-            buffer = self.ports[port_id]["in"]
-            if len(buffer) == 0:
-                logging.warning(f"port buffer #{port_id} is empty")
-                raise EmptyBufferError()
-            mux = buffer.pop(0)
-            logging.debug(f"input from port #{port_id}: {mux}")
+            try:
+                mux = self.ports[port_id]["in"].popleft()
+            except IndexError:
+                if self.interrupts is not None and self.interrupts.wait(port_id + 1):
+                    raise WaitError() from None
+                logging.warning("port buffer #%s is empty", port_id)
+                raise EmptyBufferError() from None
+            logging.debug("input from port #%s: %s", port_id, mux)
 
         return mux
 
     def do_alu_signal(self, s=1):  # noqa: C901
         if s == 0:
             return
-        instr = code_to_operation(self.signals_dict["ALU_instr"])[0]
+        instr = code_table[self.signals_dict["ALU_instr"]][0]
 
         acc = self.acc
         mux = self._get_mux_alu_input()
@@ -128,11 +269,13 @@ class DataPath:
             res = acc + mux
         elif instr == Opcode.SUB:
             res = acc - mux
-        elif instr in [Opcode.LOAD, Opcode.INPUT, Opcode.PORT1_IN, Opcode.PORT2_IN]:
+        elif instr in [Opcode.LOAD, Opcode.INPUT, Opcode.PORT1_IN, Opcode.PORT2_IN, Opcode.XCHG]:
             res = mux
         else:
             raise Exception("wrong ALU cmd {}".format(instr))  # noqa: TRY002
 
+        if self.word_bits is not None:
+            res, self.signals_dict["c"], self.signals_dict["v"] = alu_word(instr, acc, mux, res, self.word_bits)
         self.signals_dict["acc"] = res
         self.signals_dict["z"] = res == 0
 
@@ -140,6 +283,9 @@ class DataPath:
         if s == 0:
             return
         addr = self.signals_dict["reg_addr"]
+        self._check_data_addr(addr)
+        if self.cache is not None:
+            self.stall += self.cache.access(addr)
         data = self.data_mem[addr]
         self.signals_dict["MUX_addr"][0] = data
         self.signals_dict["MUX_ALU"][1] = data
@@ -149,24 +295,67 @@ class DataPath:
             return
         addr = self.signals_dict["reg_addr"]
         data = self.signals_dict["data_mem_input"]
+        self._check_data_addr(addr)
+        if self.cache is not None:
+            self.stall += self.cache.access(addr, write=True)
 
         self.data_mem[addr] = data
 
+    def _check_data_addr(self, addr):
+        # static addresses are checked on load, a computed (indirect) one may be out of the memory;
+        # a negative one would silently index from the end
+        if not 0 <= addr < self.data_mem_size:
+            raise MemoryAccessError(self.reg_ip, addr)
+
     def latch_reg_ip_signal(self, s=1):
         if s == 0:
             return
         self.reg_ip = self.signals_dict["MUX_ip"][self.mux_ip_i]
         self.signals_dict["MUX_ip"][1] = self.reg_ip + 1
         self.signals_dict["reg_ip"] = self.reg_ip
+        if self.fetch is not None:
+            self.stall += self.fetch.issue(self.reg_ip)
 
     def latch_reg_ir_signal(self, s=1):
         if s == 0:
             return
         self.reg_ir = self.signals_dict["reg_ir"]
+        if self.interrupts is not None:
+            self._check_interrupts()
 
-        if code_to_operation(self.reg_ir)[0] == Opcode.HLT:
+        if self.reg_ir == HLT_CODE:
             raise HltError()
 
+    def _check_interrupts(self):
+        """
+        Enter a requested interrupt instead of the fetched instruction; it runs after `iret`, except `hlt`.
+        With interrupts enabled `hlt` waits for scheduled input.
+        """
+        halt = self.reg_ir == HLT_CODE
+        vector = self.interrupts.request() if self.interrupt_enable else None
+        if vector is not None:
+            self.signals_dict["int_return"] = self.reg_ip + 1 if halt else self.reg_ip
+            self.signals_dict["int_vector"] = vector
+            self.reg_ir = INT_CODE
+        elif halt and self.interrupt_enable and self.interrupts.wait():
+            raise WaitError()
+
+    def interrupt_control_signal(self, s=0):
+        if s == 0:
+            return
+        if s == INT_CTL_VALUES["EI"]:
+            self.interrupt_enable = 1
+        elif s == INT_CTL_VALUES["DI"]:
+            self.interrupt_enable = 0
+        elif s == INT_CTL_VALUES["IRET"]:
+            self.signals_dict["MUX_ip"][0] = self.saved_ip
+            self.interrupt_enable = 1
+        else:
+            self.saved_ip = self.signals_dict["int_return"]
+            self.signals_dict["MUX_ip"][0] = self.signals_dict["int_vector"]
+            self.interrupt_enable = 0
+            self.interrupts.stats["interrupts"] += 1
+
     def latch_reg_addr_signal(self, s=1):
         if s == 0:
             return
@@ -204,11 +393,15 @@ class DataPath:
             return
         self.flag_z = self.signals_dict["z"]
         self.signals_dict["MUX_jmp_type"][1] = 1 - self.flag_z
+        if self.word_bits is not None:
+            self.flag_c = self.signals_dict["c"]
+            self.flag_v = self.signals_dict["v"]
 
     def output_signal(self, s=1):
         if s == 0:
             return
-        logging.debug(f"Output: {self.output_buffer_to_text()} <= {self.acc}")
+        if debug_enabled():
+            logging.debug(f"Output: {self._output_text()} <= {self.acc}")
         self.output_buffer.append(self.acc)
 
     def port_1_signal(self, s=1):
@@ -222,31 +415,86 @@ class DataPath:
         self._port_signal(1)
 
     def _port_signal(self, i):
-        logging.debug(f"Output port{i + 1}: {self.ports[i]['out']} <= {self.acc}")
+        if debug_enabled():
+            logging.debug(f"Output port{i + 1}: {self.ports[i]['out']} <= {self.acc}")
         self.ports[i]["out"].append(self.acc)
 
     def load_program(self, program_name):
+        """
+        Load a translated program, JSON or binary.
+        For binary programs no per-instruction dicts are built and code_list is None.
+        The program is checked against the memory sizes here, see check_addresses.
+        """
+        if is_binary(program_name):
+            codes, args, mem, _ = read_binary(program_name)
+            mem_list = mem.tolist()
+            self.check_sizes(len(mem_list), len(codes))
+            self.load_data_mem(mem_list)
+            self.load_encoded_instr_mem(codes, args)
+            self.check_addresses(len(codes))
+            return None, mem_list
+
         with open(program_name) as p:
             program = json.load(p)
 
-        mem_list = list()
-        for i in program["data"]:
-            if i["size"] != 1:
-                mem_list.append(i["size"])
-            mem_list += i["init"]
-
+        mem_list = data_to_mem(program["data"])
         code_list = program["code"]
 
+        self.check_sizes(program.get("data_size", len(mem_list)), program.get("code_size", len(code_list)))
         self.load_data_mem(mem_list)
         self.load_instr_mem(code_list)
+        self.check_addresses(len(code_list))
 
         return code_list, mem_list
 
+    def check_sizes(self, data_size, code_size):
+        if data_size > self.data_mem_size:
+            raise ProgramSizeError("data", data_size, self.data_mem_size)
+        if code_size > self.instruct_mem_size:
+            raise ProgramSizeError("instruction", code_size, self.instruct_mem_size)
+
+    def check_addresses(self, code_size):
+        """
+        Check every static address of the program once, so signals index memory without checks.
+        Jumps read their operand like `load label` does, so targets must fit both memories.
+        Addresses computed at run time (indirect ones) are not checked.
+        """
+        for ip in range(code_size):
+            opcode, addr_type = code_to_operation(self.instr_codes[ip])
+            if addr_type not in DATA_ADDRESSING:
+                continue
+            arg = self.instr_args[ip]
+            if opcode in [Opcode.JMP, Opcode.JMPZ] and not 0 <= arg < self.instruct_mem_size:
+                raise AddressError(ip, "instruction", arg, self.instruct_mem_size)
+            if not 0 <= arg < self.data_mem_size:
+                raise AddressError(ip, "data", arg, self.data_mem_size)
+
+    def stream_output(self, file, port_files=(None, None)):
+        """
+        Write the output buffer to `file` and the output ports to `port_files`
+        while the program runs; a port without a file keeps its list
+        """
+        self.output_buffer = OutputStream(file, render_value)
+        for port, port_file in zip(self.ports, port_files):
+            if port_file is not None:
+                port["out"] = OutputStream(port_file, render_value)
+
     def output_buffer_to_text(self):
-        res = list()
-        for i in self.output_buffer:
-            if ord(" ") <= i <= ord("z") or i == ord("\n"):
-                res.append(chr(i))
-            else:
-                res.append(i)
-        return res
+        return list(self._output_text())
+
+    def _output_text(self):
+        """
+        Text of the output buffer, rendered incrementally: only values appended
+        since the previous call are converted
+        """
+        if isinstance(self.output_buffer, OutputStream):
+            return self.output_buffer
+        for i in self.output_buffer[len(self.output_text) :]:
+            self.output_text.append(render_value(i))
+        return self.output_text
+
+
+def render_value(i):
+    if ord(" ") <= i <= ord("z") or i == ord("\n"):
+        return chr(i)
+    return i
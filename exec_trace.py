@@ -0,0 +1,275 @@
+"""
+Structured binary execution trace.
+
+TraceRecorder stores one fixed-size record per tick into preallocated NumPy
+chunks and writes full chunks to disk in bulk. The command line tool filters
+and diffs traces and renders them back into the text journal of the golden tests.
+
+File layout: header (magic "ZATR", version u16, halt code u16, stop microcode address u16,
+reserved u16, record count u64) followed by the records.
+"""
+
+import argparse
+import struct
+
+import numpy as np
+from data_path import render_value
+from isa import code_to_operation
+from mc_consts import bit_dict
+from mc_generator import generate_mc
+from tracing import LOG_FORMAT
+
+RECORD = np.dtype(
+    [
+        ("tick", "<u4"),
+        ("mc_ip", "<u2"),
+        ("ip", "<i4"),
+        ("ir", "<u2"),
+        ("addr", "<i8"),
+        ("acc", "<i8"),
+        ("alu", "<i8"),
+        ("flags", "u1"),
+    ]
+)
+
+FLAG_Z = 1
+FLAG_Z_LATCHED = 2  # flag_z was written by the ALU at least once (and is a bool since then)
+
+RESET_MC_IP = 0xFFFF  # record of the state right after ControlUnit construction
+
+MAGIC = b"ZATR"
+VERSION = 1
+HEADER = struct.Struct("<4sHHHHQ")
+
+HALT_CODES = [None, "hlt", "empty_buffer", "tick_limit"]
+
+CHUNK_SIZE = 1 << 16
+
+
+class InvalidTraceError(Exception):
+    def __init__(self, filename):
+        super().__init__(f'Not a version {VERSION} execution trace: "{filename}"')
+
+
+class TraceRecorder:
+    """
+    Records (tick, microcode address, IP, IR, ADDR, ACC, ALU output, flags) after every tick.
+    Without a file the records are kept in memory and available through `records`.
+    """
+
+    def __init__(self, filename=None, chunk_size=CHUNK_SIZE):
+        self.chunk = np.empty(chunk_size, dtype=RECORD)
+        self.pos = 0
+        self.count = 0
+        self.chunks = list()
+        self.halt_reason = None
+        self.stop_mc_ip = 0
+
+        self.file = None
+        if filename is not None:
+            self.file = open(filename, "wb")
+            self.file.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0, 0))
+
+    def record(self, tick, mc_ip, dp):
+        flags = 0
+        if dp.flag_z:
+            flags |= FLAG_Z
+        if isinstance(dp.flag_z, bool):
+            flags |= FLAG_Z_LATCHED
+        self.chunk[self.pos] = (tick, mc_ip, dp.reg_ip, dp.reg_ir, dp.reg_addr, dp.acc, dp.signals_dict["acc"], flags)
+        self.pos += 1
+        if self.pos == len(self.chunk):
+            self._flush_chunk()
+
+    def record_reset(self, dp, tick=0):
+        self.record(tick, RESET_MC_IP, dp)
+
+    def _flush_chunk(self):
+        if self.file is not None:
+            self.file.write(self.chunk[: self.pos].tobytes())
+        else:
+            self.chunks.append(self.chunk[: self.pos].copy())
+        self.count += self.pos
+        self.pos = 0
+
+    def stop(self, halt_reason, stop_mc_ip):
+        self.halt_reason = halt_reason
+        self.stop_mc_ip = stop_mc_ip
+
+    def close(self):
+        self._flush_chunk()
+        if self.file is None:
+            return
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, HALT_CODES.index(self.halt_reason), self.stop_mc_ip, 0, self.count))
+        self.file.close()
+        self.file = None
+
+    def records(self):
+        chunks = self.chunks + [self.chunk[: self.pos]]
+        return np.concatenate(chunks)
+
+
+def load_trace(filename):
+    with open(filename, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise InvalidTraceError(filename)
+    magic, version, halt_code, stop_mc_ip, _, count = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise InvalidTraceError(filename)
+
+    records = np.fromfile(filename, dtype=RECORD, count=count, offset=HEADER.size)
+    return records, HALT_CODES[halt_code], stop_mc_ip
+
+
+def _log_line(level, module, func, message):
+    return LOG_FORMAT % {"levelname": level, "module": module, "funcName": func, "message": message}
+
+
+def _state_line(r):
+    cmd, addr = (i.name for i in code_to_operation(int(r["ir"])))
+    z = bool(r["flags"] & FLAG_Z) if r["flags"] & FLAG_Z_LATCHED else int(r["flags"] & FLAG_Z)
+    return _log_line(
+        "DEBUG",
+        "control_unit",
+        "log_state",
+        f"IP: {r['ip']}; IR: cmd: {cmd}, addr {addr}; ADDR: {r['addr']}; Z: {z}; ACC: {r['acc']}",
+    )
+
+
+def _tick_lines(r, line, outputs):
+    """
+    Journal lines of one tick, in the order the signals are handled
+    """
+    input_mux = line[bit_dict["MUX_ALU_INPUT"]]
+    if line[bit_dict["ALU"]] and input_mux == 1:
+        yield _log_line("DEBUG", "data_path", "_get_mux_alu_input", f"input: {r['alu']}")
+    elif line[bit_dict["ALU"]] and input_mux > 1:
+        yield _log_line("DEBUG", "data_path", "_get_mux_alu_input", f"input from port #{input_mux - 2}: {r['alu']}")
+
+    if line[bit_dict["OUTPUT"]]:
+        yield _log_line("DEBUG", "data_path", "output_signal", f"Output: {outputs[0]} <= {r['acc']}")
+        outputs[0].append(render_value(int(r["acc"])))
+
+    if line[bit_dict["M_MUX_IP"]] == 0:
+        yield _state_line(r)
+
+    for port, name in enumerate(["PORT1_OUT", "PORT2_OUT"]):
+        if line[bit_dict[name]]:
+            yield _log_line(
+                "DEBUG", "data_path", "_port_signal", f"Output port{port + 1}: {outputs[port + 1]} <= {r['acc']}"
+            )
+            outputs[port + 1].append(int(r["acc"]))
+
+
+def _stop_lines(halt_reason, stop_line):
+    if halt_reason == "empty_buffer":
+        input_mux = stop_line[bit_dict["MUX_ALU_INPUT"]]
+        if input_mux == 1:
+            yield _log_line("WARNING", "data_path", "_get_mux_alu_input", "Input buffer is empty!")
+        else:
+            yield _log_line("WARNING", "data_path", "_get_mux_alu_input", f"port buffer #{input_mux - 2} is empty")
+    elif halt_reason == "tick_limit":
+        yield _log_line("ERROR", "control_unit", "juggernaut", "Tick limit exceeded")
+
+
+def render_log(records, halt_reason, stop_mc_ip, mc_mem=None):
+    """
+    Rebuild the text journal which ControlUnit writes with logging enabled
+    """
+    if mc_mem is None:
+        mc_mem = generate_mc()[0]
+
+    outputs = [list(), list(), list()]
+    lines = list()
+    for r in records:
+        if r["mc_ip"] == RESET_MC_IP:
+            lines.append(_state_line(r))
+            continue
+        lines.extend(_tick_lines(r, mc_mem[r["mc_ip"]], outputs))
+    lines.extend(_stop_lines(halt_reason, mc_mem[stop_mc_ip]))
+
+    return "".join(i + "\n" for i in lines)
+
+
+def filter_records(records, ticks=None, ip=None, mc_ip=None):
+    mask = np.ones(len(records), dtype=bool)
+    if ticks is not None:
+        mask &= (records["tick"] >= ticks[0]) & (records["tick"] <= ticks[1])
+    if ip is not None:
+        mask &= records["ip"] == ip
+    if mc_ip is not None:
+        mask &= records["mc_ip"] == mc_ip
+    return records[mask]
+
+
+def diff_traces(first, second):
+    """
+    Index of the first differing record and the names of differing fields, or None
+    """
+    size = min(len(first), len(second))
+    differs = np.zeros(size, dtype=bool)
+    for name in RECORD.names:
+        differs |= first[name][:size] != second[name][:size]
+    if differs.any():
+        i = int(np.argmax(differs))
+        return i, [name for name in RECORD.names if first[name][i] != second[name][i]]
+    if len(first) != len(second):
+        return size, ["length"]
+    return None
+
+
+def _print_records(records):
+    print("tick mc_ip ip ir addr acc alu flags")
+    for r in records:
+        print(" ".join(str(r[name]) for name in RECORD.names))
+
+
+def _parse_ticks(text):
+    first, last = text.split(":")
+    return int(first), int(last)
+
+
+def main(args):
+    if args.command == "log":
+        text = render_log(*load_trace(args.trace))
+        if args.output is None:
+            print(text, end="")
+        else:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(text)
+    elif args.command == "show":
+        records, _, _ = load_trace(args.trace)
+        _print_records(filter_records(records, args.ticks, args.ip, args.mc_ip))
+    elif args.command == "diff":
+        first, second = load_trace(args.trace)[0], load_trace(args.other)[0]
+        res = diff_traces(first, second)
+        if res is None:
+            print("Traces are equal")
+        else:
+            i, fields = res
+            print(f"First difference at record {i}: {', '.join(fields)}")
+            _print_records(first[i : i + 1])
+            _print_records(second[i : i + 1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect binary execution traces")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    log_parser = commands.add_parser("log", help="render the text journal")
+    log_parser.add_argument("trace")
+    log_parser.add_argument("-o", "--output")
+
+    show_parser = commands.add_parser("show", help="print records")
+    show_parser.add_argument("trace")
+    show_parser.add_argument("--ticks", type=_parse_ticks, metavar="FIRST:LAST")
+    show_parser.add_argument("--ip", type=int)
+    show_parser.add_argument("--mc-ip", type=int)
+
+    diff_parser = commands.add_parser("diff", help="find the first difference of two traces")
+    diff_parser.add_argument("trace")
+    diff_parser.add_argument("other")
+
+    main(parser.parse_args())
@@ -0,0 +1,303 @@
+"""
+Instruction-level model of the machine.
+
+Executes translated code instruction by instruction instead of stepping the
+microcode, but reports the same tick and command counts as ControlUnit:
+tick costs of every instruction are taken from the microcode ROM.
+"""
+
+import argparse
+import logging
+
+from control_unit import TICK_LIMIT, load_data_path, print_result
+from data_path import DataPath, EmptyBufferError, MemoryAccessError, add_memory_arguments, alu_word, memory_config
+from isa import Address, Opcode, allowed_addressing, code_to_operation, operation_to_code
+from mc_consts import bit_dict
+from mc_generator import block_lines, generate_mc, tick_costs
+
+ALU_FUNCS = {
+    Opcode.INC: lambda acc, mux: acc + 1,
+    Opcode.DEC: lambda acc, mux: acc - 1,
+    Opcode.CLS: lambda acc, mux: 0,
+    Opcode.NEG: lambda acc, mux: -acc,
+    Opcode.ADD: lambda acc, mux: acc + mux,
+    Opcode.SUB: lambda acc, mux: acc - mux,
+    Opcode.LOAD: lambda acc, mux: mux,
+}
+
+
+class CacheNotSupportedError(Exception):
+    def __init__(self):
+        super().__init__("The instruction-level model has no data cache timing, use ControlUnit")
+
+
+class InterruptsNotSupportedError(Exception):
+    def __init__(self):
+        super().__init__("The instruction-level model has no timed port input, use ControlUnit")
+
+
+class InstructionMachine:
+    """
+    Runs the program loaded into a DataPath with a dispatch table keyed by
+    instruction code. Only the architectural state is kept up to date:
+    acc, flags, data and I/O buffers. When the tick limit stops the run inside
+    an instruction, only the effects of the microsteps within the limit are
+    applied, as ControlUnit does: the input read of an input instruction and
+    the memory write of `xchg`.
+    """
+
+    def __init__(self, dp: DataPath, microcode=None):
+        if dp.cache is not None:
+            raise CacheNotSupportedError()
+        if dp.interrupts is not None:
+            raise InterruptsNotSupportedError()
+        self.dp = dp
+        self.halt_reason = None
+        self.acc = dp.acc
+        self.flag_z = dp.flag_z
+        self.flag_c = dp.flag_c
+        self.flag_v = dp.flag_v
+        self.reg_addr = dp.reg_addr
+        self.cmd_count = 1
+
+        microcode = generate_mc() if microcode is None else microcode
+        self.costs, self.stop_costs = tick_costs(*microcode)
+        self.write_costs = _write_costs(*microcode)
+        self.program = list(zip(dp.instr_codes, dp.instr_args))
+
+        # input buffers of the input instructions and memory writes of `xchg` by code
+        self.inputs = dict()
+        self.writes = dict()
+        self.dispatch = dict()
+        for opcode, addr_list in allowed_addressing.items():
+            for addr in addr_list:
+                self.dispatch[operation_to_code(opcode, addr)] = self._make_handler(opcode, addr)
+
+    def _make_operand(self, addr):
+        mem = self.dp.data_mem
+
+        if addr == Address.LABEL_VAL:
+
+            def operand(arg):
+                self.reg_addr = arg
+                return mem[arg]
+
+        elif addr == Address.INDIRECT:
+
+            def operand(arg):
+                addr = self.reg_addr = mem[arg]
+                if addr < 0:
+                    # a negative index would wrap around, the juggernaut reports it as MemoryAccessError
+                    raise IndexError(addr)
+                return mem[addr]
+
+        else:
+
+            def operand(arg):
+                return arg
+
+        return operand
+
+    def _make_handler(self, opcode, addr):  # noqa: C901
+        dp = self.dp
+        operand = self._make_operand(addr)
+
+        if opcode in ALU_FUNCS and dp.word_bits is not None:
+            func = ALU_FUNCS[opcode]
+
+            def handler(arg):
+                acc, mux = self.acc, operand(arg)
+                self._latch_word(alu_word(opcode, acc, mux, func(acc, mux), dp.word_bits))
+
+        elif opcode in ALU_FUNCS:
+            func = ALU_FUNCS[opcode]
+
+            def handler(arg):
+                self._latch_acc(func(self.acc, operand(arg)))
+
+        elif opcode == Opcode.STORE:
+
+            def handler(arg):
+                operand(arg)
+                dp.data_mem[self.reg_addr] = self.acc
+
+        elif opcode == Opcode.XCHG:
+
+            def write(arg):
+                operand(arg)
+                dp.data_mem[self.reg_addr] = self.acc
+
+            self.writes[operation_to_code(opcode, addr)] = write
+
+            def handler(arg):
+                value = operand(arg)
+                dp.data_mem[self.reg_addr] = self.acc
+                if dp.word_bits is None:
+                    self._latch_acc(value)
+                else:
+                    self._latch_word(alu_word(opcode, self.acc, value, value, dp.word_bits))
+
+        elif opcode == Opcode.JMP:
+
+            def handler(arg):
+                operand(arg)
+                return arg
+
+        elif opcode == Opcode.JMPZ:
+
+            def handler(arg):
+                operand(arg)
+                return arg if self.flag_z else None
+
+        elif opcode in [Opcode.INPUT, Opcode.PORT1_IN, Opcode.PORT2_IN]:
+            buffer = self.inputs[operation_to_code(opcode, addr)] = self._input_buffer(opcode)
+
+            def handler(arg):
+                try:
+                    value = buffer.popleft()
+                except IndexError:
+                    raise EmptyBufferError() from None
+                if dp.word_bits is None:
+                    self._latch_acc(value)
+                else:
+                    self._latch_word(alu_word(opcode, self.acc, value, value, dp.word_bits))
+
+        elif opcode in [Opcode.OUTPUT, Opcode.PORT1_OUT, Opcode.PORT2_OUT]:
+            buffer = self._output_buffer(opcode)
+
+            def handler(arg):
+                buffer.append(self.acc)
+
+        elif opcode in [Opcode.EI, Opcode.DI]:
+            enable = int(opcode == Opcode.EI)
+
+            def handler(arg):
+                dp.interrupt_enable = enable
+
+        elif opcode == Opcode.IRET:
+
+            def handler(arg):
+                dp.interrupt_enable = 1
+                return dp.saved_ip
+
+        else:
+            handler = None
+
+        return handler
+
+    def _input_buffer(self, opcode):
+        if opcode == Opcode.INPUT:
+            return self.dp.input_buffer
+        return self.dp.ports[0 if opcode == Opcode.PORT1_IN else 1]["in"]
+
+    def _output_buffer(self, opcode):
+        if opcode == Opcode.OUTPUT:
+            return self.dp.output_buffer
+        return self.dp.ports[0 if opcode == Opcode.PORT1_OUT else 1]["out"]
+
+    def _latch_acc(self, res):
+        self.acc = res
+        self.flag_z = res == 0
+
+    def _latch_word(self, alu_res):
+        res, self.flag_c, self.flag_v = alu_res
+        self._latch_acc(res)
+
+    def juggernaut(self, tick_limit=TICK_LIMIT):
+        program = self.program
+        dispatch = self.dispatch
+        costs = self.costs
+        limit = int(tick_limit)
+        tick = 0
+        ip = 0
+        while True:
+            code, arg = program[ip]
+            handler = dispatch[code]
+            if handler is None or tick + costs[code] > limit + 1:
+                # ControlUnit stops inside the instruction, before the microstep of its effects
+                self.halt_reason = self._stop_reason(code, arg, tick, limit)
+                tick = tick + self.stop_costs[code] if self.halt_reason != "tick_limit" else limit + 1
+                break
+            try:
+                next_ip = handler(arg)
+            except EmptyBufferError:
+                tick += self.stop_costs[code]
+                self.halt_reason = "empty_buffer"
+                break
+            except IndexError as e:
+                raise MemoryAccessError(ip, self.reg_addr) from e
+            tick += costs[code]
+            # the next command is fetched on the last tick of this one, exactly as ControlUnit counts it
+            self.cmd_count += 1
+            if tick > limit:
+                self.halt_reason = "tick_limit"
+                break
+            ip = ip + 1 if next_ip is None else next_ip
+
+        self._sync(ip, code)
+        if self.halt_reason == "tick_limit":
+            logging.error("Tick limit exceeded")
+            return -1
+        return tick
+
+    def _stop_reason(self, code, arg, tick, limit):
+        """
+        Why the machine stops on instruction `code` which does not complete: `hlt`, a read from an empty
+        buffer or the tick limit. Of an instruction cut by the limit only the input read and the `xchg`
+        memory write are done, if their microsteps are within the limit.
+        """
+        if code in self.write_costs and tick + self.write_costs[code] <= limit + 1:
+            self.writes[code](arg)
+        if code not in self.stop_costs or tick + self.stop_costs[code] > limit:
+            return "tick_limit"
+        if self.dispatch[code] is None:
+            return "hlt"
+        buffer = self.inputs[code]
+        if not buffer:
+            return "empty_buffer"
+        buffer.popleft()
+        return "tick_limit"
+
+    def _sync(self, ip, code):
+        self.dp.acc = self.acc
+        self.dp.flag_z = self.flag_z
+        self.dp.flag_c = self.flag_c
+        self.dp.flag_v = self.flag_v
+        self.dp.reg_addr = self.reg_addr
+        self.dp.reg_ip = ip
+        self.dp.reg_ir = code
+
+
+def _write_costs(mc_mem, start_ids):
+    """
+    Ticks of `xchg` up to its memory write, which comes before the end of the instruction
+    """
+    costs = tick_costs(mc_mem, start_ids)[0]
+    res = dict()
+    for code, start in start_ids.items():
+        if code_to_operation(code)[0] == Opcode.XCHG:
+            lines = block_lines(mc_mem, start)
+            din = next(i for i in lines if mc_mem[i][bit_dict["DIN"]])
+            res[code] = costs[code] - len(lines) + din - start + 1
+    return res
+
+
+def main(scr_name, input_name, tick_limit=TICK_LIMIT, memory=None, merge_microcode=False):
+    dp = load_data_path(scr_name, input_name, memory=memory)
+
+    machine = InstructionMachine(dp, microcode=generate_mc(merge=merge_microcode))
+
+    tick_count = machine.juggernaut(tick_limit)
+
+    print_result(dp, tick_count, machine.cmd_count)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Instruction-level machine model")
+    parser.add_argument("source_file")
+    parser.add_argument("input_file")
+    parser.add_argument("--tick-limit", type=int, default=TICK_LIMIT, help="stop after this many ticks")
+    add_memory_arguments(parser)
+    parser.add_argument("--merge-microcode", action="store_true", help="count ticks of the merged microcode ROM")
+    args = parser.parse_args()
+    main(args.source_file, args.input_file, args.tick_limit, memory_config(args), args.merge_microcode)
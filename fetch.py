@@ -0,0 +1,96 @@
+"""
+Instruction fetch model.
+
+Like the data cache (see cache.py) the fetch unit only models timing: the START
+microinstructions still latch IP and read `DataPath.instr_codes`, the fetch
+unit reports how many ticks each of them stalls or saves.
+
+- An optional instruction cache, a read-only `Cache` in front of the
+  instruction memory, charges its miss latency on the IM microinstruction.
+- With `overlap` the next instruction is fetched during the last microstep of
+  the current one, predicting that it follows the current one in memory. When
+  the prediction holds, the IP and IM microinstructions of START take no ticks
+  of their own and only IR (decode) is paid. A taken `jmp`/`jmpz` mispredicts:
+  the prefetched instruction is flushed and START runs at full cost plus
+  `flush_penalty` ticks.
+"""
+
+from cache import Cache
+
+STAT_NAMES = ["fetches", "overlapped", "mispredictions", "saved_ticks", "flush_ticks"]
+
+
+class FetchUnit:
+    def __init__(self, overlap=False, flush_penalty=1, icache=None):
+        """
+        `icache` is a dict of Cache parameters, there is no instruction cache without it
+        """
+        self.overlap = overlap
+        self.flush_penalty = flush_penalty
+        self.icache = None if icache is None else Cache(**icache)
+
+        self.last_ip = None
+        self.predicted = False
+        self.stats = dict.fromkeys(STAT_NAMES, 0)
+
+    def issue(self, ip):
+        """
+        IP microinstruction of START: returns its extra ticks (-1 when it is overlapped)
+        """
+        stats = self.stats
+        stats["fetches"] += 1
+        self.predicted = False
+        last_ip, self.last_ip = self.last_ip, ip
+        if not self.overlap or last_ip is None:
+            return 0
+        if ip != last_ip + 1:
+            stats["mispredictions"] += 1
+            stats["flush_ticks"] += self.flush_penalty
+            return self.flush_penalty
+
+        self.predicted = True
+        stats["overlapped"] += 1
+        stats["saved_ticks"] += 2
+        return -1
+
+    def read(self, ip):
+        """
+        IM microinstruction of START: returns its extra ticks
+        """
+        stall = 0 if self.icache is None else self.icache.access(ip)
+        return stall - 1 if self.predicted else stall
+
+    def report(self, tick_count, cmd_count):
+        counters = ", ".join(f"{name}: {self.stats[name]}" for name in STAT_NAMES)
+        cpi = tick_count / cmd_count if tick_count > 0 and cmd_count else 0
+        text = f"Fetch (overlap: {'on' if self.overlap else 'off'}): {counters}, CPI: {cpi:.3f}"
+        if self.icache is not None:
+            text += "\nInstruction " + self.icache.report()
+        return text
+
+
+def add_fetch_arguments(parser):
+    group = parser.add_argument_group("instruction fetch")
+    group.add_argument("--overlap-fetch", action="store_true", help="fetch the next instruction on the last microstep")
+    group.add_argument("--flush-penalty", type=int, default=1, help="extra ticks of a taken jump with --overlap-fetch")
+    group.add_argument("--icache-size", type=int, help="enable the instruction cache of this many instructions")
+    group.add_argument("--icache-line", type=int, default=4, help="instructions per line")
+    group.add_argument("--icache-ways", type=int, default=2, help="associativity")
+    group.add_argument("--icache-latency", type=int, default=10, help="ticks of one instruction memory read")
+
+
+def fetch_config(args):
+    """
+    FetchUnit parameters from parsed arguments, or None when fetch is not modelled
+    """
+    if not args.overlap_fetch and args.icache_size is None:
+        return None
+    icache = None
+    if args.icache_size is not None:
+        icache = {
+            "size": args.icache_size,
+            "line_size": args.icache_line,
+            "ways": args.icache_ways,
+            "memory_latency": args.icache_latency,
+        }
+    return {"overlap": args.overlap_fetch, "flush_penalty": args.flush_penalty, "icache": icache}
@@ -4,22 +4,30 @@
 """
 
 import contextlib
+import functools
 import io
 import json
 import logging
 import os
 import tempfile
 
+import batch
+import cache
 import control_unit
+import data_path
+import exec_trace
+import fast_machine
+import interrupts
+import mc_generator
+import multicore
+import profiler
 import pytest
+import simd_sim
+import streams
 import translator
 
 
-@pytest.mark.golden_test("golden/*.yml")
-def test_translator_and_machine(golden, caplog):
-    # Установим уровень отладочного вывода на DEBUG
-    caplog.set_level(logging.DEBUG)
-
+def _run_golden(golden, machine=control_unit.main, fmt="json", **kwargs):
     # Создаём временную папку для тестирования приложения.
     with tempfile.TemporaryDirectory() as tmpdirname:
         # Готовим имена файлов для входных и выходных данных.
@@ -36,14 +44,539 @@ def test_translator_and_machine(golden, caplog):
         # Запускаем транслятор и собираем весь стандартный вывод в переменную
         # stdout
         with contextlib.redirect_stdout(io.StringIO()) as stdout:
-            translator.main(source, target)
-            control_unit.main(target, input_stream)
+            translator.main(source, target, fmt)
+            machine(target, input_stream, **kwargs)
 
         # Выходные данные также считываем в переменные.
-        with open(target, encoding="utf-8") as file:
+        with open(target, "rb") as file:
             code = file.read()
 
-        # Проверяем, что ожидания соответствуют реальности.
-        assert json.loads(code) == json.loads(golden.out["out_code"])
-        assert stdout.getvalue() == golden.out["out_stdout"]
-        assert caplog.text == golden.out["out_log"]
+    return code, stdout.getvalue()
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_translator_and_machine(golden, caplog):
+    # Установим уровень отладочного вывода на DEBUG
+    caplog.set_level(logging.DEBUG)
+
+    code, stdout = _run_golden(golden)
+
+    # Проверяем, что ожидания соответствуют реальности.
+    assert json.loads(code) == json.loads(golden.out["out_code"])
+    assert stdout == golden.out["out_stdout"]
+    assert caplog.text == golden.out["out_log"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_predecoded_machine(golden, caplog):
+    caplog.set_level(logging.DEBUG)
+
+    _, stdout = _run_golden(golden, predecoded=True)
+
+    assert stdout == golden.out["out_stdout"]
+    assert caplog.text == golden.out["out_log"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_instruction_machine(golden):
+    _, stdout = _run_golden(golden, machine=fast_machine.main)
+
+    assert stdout == golden.out["out_stdout"]
+
+
+def _translate_golden(golden, tmp_path):
+    source = tmp_path / "source.asm"
+    input_stream = tmp_path / "input.txt"
+    target = tmp_path / "target.za"
+    source.write_text(golden["in_source"], encoding="utf-8")
+    input_stream.write_text(golden["in_stdin"], encoding="utf-8")
+    with contextlib.redirect_stdout(io.StringIO()):
+        translator.main(source, target)
+    return target, input_stream
+
+
+def _machine_state(machine, dp, tick_limit):
+    tick = machine.juggernaut(tick_limit)
+    ports = [(list(port["in"]), port["out"]) for port in dp.ports]
+    return tick, machine.cmd_count, machine.halt_reason, dp.acc, dp.output_buffer, list(dp.input_buffer), ports
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_instruction_machine_tick_limit(golden, tmp_path):
+    target, input_stream = _translate_golden(golden, tmp_path)
+
+    # Лимит тиков обрывает команды на разных микрошагах: состояние должно совпадать с ControlUnit.
+    for tick_limit in range(1, 400, 7):
+        dp = control_unit.load_data_path(target, input_stream)
+        expected = _machine_state(control_unit.ControlUnit(dp, predecoded=True), dp, tick_limit)
+        expected_mem = list(dp.data_mem)
+        dp = control_unit.load_data_path(target, input_stream)
+        assert _machine_state(fast_machine.InstructionMachine(dp), dp, tick_limit) == expected
+        assert list(dp.data_mem) == expected_mem
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_binary_program(golden, caplog):
+    caplog.set_level(logging.DEBUG)
+
+    _, stdout = _run_golden(golden, fmt="bin")
+
+    assert stdout == golden.out["out_stdout"]
+    assert caplog.text == golden.out["out_log"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_trace_file(golden, tmp_path):
+    trace_file = tmp_path / "trace.log"
+
+    _run_golden(golden, trace_file=trace_file)
+
+    assert trace_file.read_text(encoding="utf-8") == golden.out["out_log"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_execution_trace(golden, tmp_path):
+    record_file = tmp_path / "trace.bin"
+
+    _run_golden(golden, record_file=record_file)
+
+    assert exec_trace.render_log(*exec_trace.load_trace(record_file)) == golden.out["out_log"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_checkpoint_resume(golden, tmp_path):
+    checkpoint_file = tmp_path / "state.zacp"
+
+    _run_golden(golden, tick_limit=100, checkpoint_file=checkpoint_file)
+    with contextlib.redirect_stdout(io.StringIO()) as stdout:
+        control_unit.main(None, None, resume_file=checkpoint_file)
+
+    assert stdout.getvalue() == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_checkpoint_with_streams(golden, tmp_path):
+    # Потоки -- открытые файлы, сохранить их в контрольную точку нельзя: запуск отклоняется сразу
+    checkpoint_file = tmp_path / "state.zacp"
+
+    for stream in ["stream_input", "stream_output"]:
+        with pytest.raises(control_unit.StreamCheckpointError):
+            _run_golden(golden, tick_limit=30, checkpoint_file=checkpoint_file, **{stream: True})
+    assert not checkpoint_file.exists()
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_stream_input(golden):
+    # Потоковый ввод декодируется так же, как файл целиком: первое слово без пробелов вокруг,
+    # в том числе когда блоки чтения режут слово или пробелы
+    text = " \n " + golden["in_stdin"] + "  \n"
+    expected = list(streams.decode_input(text)[0])
+    for chunk_size in [1, 2, 3, streams.CHUNK_SIZE]:
+        stream = streams.InputStream(io.StringIO(text), chunk_size)
+        values = list()
+        with contextlib.suppress(IndexError):
+            while True:
+                values.append(stream.popleft())
+        assert values == expected
+
+    # Без ввода портов результат не зависит от режима
+    if len(golden["in_stdin"].split()) <= 1:
+        _, stdout = _run_golden(golden, stream_input=True)
+        assert stdout == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_stream_output(golden):
+    _, stdout = _run_golden(golden, stream_output=True)
+
+    assert stdout == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_data_cache_without_latency(golden):
+    _, stdout = _run_golden(golden, cache={"size": 16, "memory_latency": 0})
+
+    result, cache_report = stdout.rsplit("\n", 2)[:2]
+    assert result + "\n" == golden.out["out_stdout"]
+    assert cache_report.startswith("Cache 16/4/2")
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_data_cache_latency(golden, tmp_path):
+    target, input_stream = _translate_golden(golden, tmp_path)
+    dp = control_unit.load_data_path(target, input_stream)
+    cu = control_unit.ControlUnit(dp)
+    expected = cu.juggernaut(), cu.cmd_count, dp.output_buffer
+
+    # Маленький кеш с обратной записью: каждый промах и каждая выгрузка грязной строки стоят 7 тактов
+    latency = 7
+    dp = control_unit.load_data_path(target, input_stream)
+    dp.cache = cache.Cache(size=4, line_size=1, ways=2, memory_latency=latency)
+    cu = control_unit.ControlUnit(dp)
+    tick = cu.juggernaut()
+
+    stats = dp.cache.stats
+    assert (cu.cmd_count, dp.output_buffer) == expected[1:]
+    assert stats["hits"] + stats["misses"] == stats["reads"] + stats["writes"]
+    assert tick - expected[0] == stats["stall_ticks"] == (stats["misses"] + stats["writebacks"]) * latency
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_profiler(golden):
+    _, stdout = _run_golden(golden, profile=5)
+
+    result, report = stdout.split("Profile: ")
+    assert result == golden.out["out_stdout"]
+    tick_count, cmd_count = result.split("Tick count: ")[1].split("Command count: ")
+    assert report.startswith(f"{tick_count.rstrip(', ')} ticks, {cmd_count.strip()} instructions")
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_profiler_tick_limit(golden, tmp_path):
+    target, input_stream = _translate_golden(golden, tmp_path)
+
+    # Лимит тиков останавливает машину и посреди выборки команды: число инструкций совпадает с cmd_count
+    for tick_limit in range(1, 40):
+        dp = control_unit.load_data_path(target, input_stream)
+        prof = profiler.Profiler(control_unit.ControlUnit(dp).mc_mem, dp.instruct_mem_size)
+        cu = control_unit.ControlUnit(dp, observers=[prof])
+        cu.juggernaut(tick_limit)
+        assert sum(prof.counts) == cu.cmd_count
+        assert sum(prof.ticks) == cu.tick
+
+
+@pytest.mark.golden_test("golden/optimizer/*.yml")
+def test_optimizer(golden):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source = os.path.join(tmpdirname, "source.asm")
+        input_stream = os.path.join(tmpdirname, "input.txt")
+        target = os.path.join(tmpdirname, "target.za")
+        with open(source, "w", encoding="utf-8") as file:
+            file.write(golden["in_source"])
+        with open(input_stream, "w", encoding="utf-8") as file:
+            file.write(golden["in_stdin"])
+
+        # Программа с прерываниями получает ввод портов по расписанию
+        schedule = None
+        if golden.get("in_schedule") is not None:
+            schedule = os.path.join(tmpdirname, "schedule.json")
+            with open(schedule, "w", encoding="utf-8") as file:
+                file.write(golden["in_schedule"])
+
+        with contextlib.redirect_stdout(io.StringIO()) as report:
+            translator.main(source, target, optimize=True)
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            control_unit.main(target, input_stream, schedule=schedule)
+
+    assert report.getvalue() == golden.out["out_report"]
+    assert stdout.getvalue() == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_jit_machine(golden):
+    _, stdout = _run_golden(golden, jit=True)
+
+    assert stdout == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/jit/*.yml")
+def test_jit_state(golden, tmp_path):
+    _, stdout = _run_golden(golden, jit=True)
+    assert stdout == golden.out["out_stdout"]
+
+    target, input_stream = _translate_golden(golden, tmp_path)
+    # Трасса выходит из цикла с тем же состоянием регистров и памяти, что и микрокод.
+    for tick_limit in [300, 500, 700, control_unit.TICK_LIMIT]:
+        states = list()
+        for jit in [False, True]:
+            dp = control_unit.load_data_path(target, input_stream)
+            cu = control_unit.ControlUnit(dp, predecoded=True, jit=jit)
+            states.append((_machine_state(cu, dp, tick_limit), dp.reg_addr, dp.flag_z, list(dp.data_mem)))
+        assert states[0] == states[1]
+
+
+def _simd_run(target, input_name):
+    simd_sim.run_inputs(target, [input_name])
+
+
+@pytest.mark.golden_test("golden/memory_access/*.yml")
+def test_memory_access_error(golden):
+    # Вычисленный косвенный адрес вне памяти данных -- ошибка в любом движке, отрицательный не берётся с конца
+    engines = [
+        {},
+        {"predecoded": True},
+        {"jit": True},
+        {"machine": fast_machine.main},
+        {"machine": _simd_run},
+        {"machine": functools.partial(multicore.main, cores=1)},
+    ]
+    for kwargs in engines:
+        with pytest.raises(data_path.MemoryAccessError) as error:
+            _run_golden(golden, **kwargs)
+        assert str(error.value) + "\n" == golden.out["out_error"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_word_bits(golden):
+    # Значения golden-программ помещаются в 64-битное слово
+    _, stdout = _run_golden(golden, memory={"word_bits": 64})
+
+    assert stdout == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/word_bits/*.yml")
+def test_word_overflow(golden, caplog, tmp_path):
+    # Журнал показывает acc и флаги C, V после каждой команды: переполнение add, sub, neg, inc и dec
+    caplog.set_level(logging.DEBUG)
+    memory = {"word_bits": golden["in_word_bits"]}
+
+    _, stdout = _run_golden(golden, memory=memory)
+
+    assert stdout == golden.out["out_stdout"]
+    assert caplog.text == golden.out["out_log"]
+
+    # fast_machine переполняется так же на границе каждой команды
+    target, input_stream = _translate_golden(golden, tmp_path)
+    for tick_limit in range(1, 100):
+        states = list()
+        for machine in [functools.partial(control_unit.ControlUnit, predecoded=True), fast_machine.InstructionMachine]:
+            dp = control_unit.load_data_path(target, input_stream, memory=memory)
+            states.append((_machine_state(machine(dp), dp, tick_limit), dp.flag_c, dp.flag_v, list(dp.data_mem)))
+        assert states[0] == states[1]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_translation_from_open_file(golden, tmp_path):
+    source = tmp_path / "source.asm"
+    source.write_text(golden["in_source"], encoding="utf-8")
+
+    # Транслятор читает и имя файла, и открытый файл
+    with open(source, encoding="utf-8") as file:
+        translator.Translator(file).translate(tmp_path / "from_file.za")
+    translator.Translator(str(source)).translate(tmp_path / "from_name.za")
+
+    assert (tmp_path / "from_file.za").read_text() == (tmp_path / "from_name.za").read_text()
+
+
+@pytest.mark.golden_test("golden/errors/*.yml")
+def test_translator_errors(golden, tmp_path):
+    # Ошибка указывает строку и столбец исходного файла и цитирует исходную строку
+    with pytest.raises(translator.InvalidCodeError) as error:
+        translator.Translator(io.StringIO(golden["in_source"])).translate(tmp_path / "target.za")
+
+    assert str(error.value) + "\n" == golden.out["out_error"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_incremental_translation(golden, tmp_path):
+    source = tmp_path / "source.asm"
+    target = tmp_path / "target.za"
+    cache_file = tmp_path / "translation.cache"
+    source.write_text(golden["in_source"], encoding="utf-8")
+
+    # Первый запуск заполняет кеш, второй переиспользует все регионы
+    for _ in range(2):
+        tr = translator.IncrementalTranslator(source, cache_file)
+        tr.translate(target)
+        assert json.loads(target.read_text()) == json.loads(golden.out["out_code"])
+
+    assert tr.stats["parsed"] == tr.stats["relinked"] == 0
+    # Кеш -- обычный JSON, загрузка не исполняет код
+    assert json.loads(cache_file.read_text(encoding="utf-8"))["version"] == translator.TRANSLATION_CACHE_VERSION
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_incremental_translation_after_edit(golden, tmp_path):
+    source = tmp_path / "source.asm"
+    target = tmp_path / "target.za"
+    full_target = tmp_path / "full.za"
+    cache_file = tmp_path / "translation.cache"
+    text = golden["in_source"]
+    source.write_text(text, encoding="utf-8")
+    translator.IncrementalTranslator(source, cache_file).translate(target)
+
+    edits = [
+        # Новая команда в начале кода сдвигает все метки кода
+        ("section .code\n", "section .code\n    cls\n"),
+        # Новая ячейка в начале данных сдвигает все метки данных
+        ("section .data\n", "section .data\n    pad: 0x7\n"),
+        # Замена команды на месте ничего не сдвигает
+        ("section .code\n    cls\n", "section .code\n    inc\n"),
+    ]
+    for old, new in edits:
+        if old not in text:
+            # в программе нет секции данных
+            continue
+        text = text.replace(old, new, 1)
+        source.write_text(text, encoding="utf-8")
+
+        tr = translator.IncrementalTranslator(source, cache_file)
+        tr.translate(target)
+        translator.Translator(source).translate(full_target)
+
+        assert target.read_text() == full_target.read_text()
+        assert tr.stats["parsed"] == 1
+
+
+def _sequential_run(target, input_stream, tick_limit, cache_options=None, memory=None):
+    try:
+        dp = control_unit.load_data_path(target, input_stream, memory=memory)
+    except (data_path.ProgramSizeError, data_path.AddressError):
+        return {"halt_reason": "error"}
+    if cache_options is not None:
+        dp.cache = cache.Cache(**cache_options)
+    cu = control_unit.ControlUnit(dp, predecoded=True)
+    result = {"tick_count": cu.juggernaut(tick_limit), "cmd_count": cu.cmd_count, "halt_reason": cu.halt_reason}
+    result.update({"output": dp.output_buffer, "ports": [dp.ports[0]["out"], dp.ports[1]["out"]]})
+    if dp.cache is not None:
+        result["cache"] = dp.cache.stats
+    return result
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_batch(golden, tmp_path):
+    target, input_stream = _translate_golden(golden, tmp_path)
+    cases = [{"name": str(i), "program": str(target), "input": str(input_stream)} for i in range(3)]
+    # Параметры запуска должны доходить до процессов пула: лимит обрывает длинные программы,
+    # в одну ячейку памяти данных не помещаются программы с данными
+    runs = [
+        {"tick_limit": 500, "cache": {"size": 8, "memory_latency": 3}, "memory": {"word_bits": 32}},
+        {"tick_limit": control_unit.TICK_LIMIT, "memory": {"data_mem_size": 1}},
+    ]
+
+    for options in runs:
+        results = batch.run_batch(cases, workers=2, **options)
+
+        expected = _sequential_run(target, input_stream, options["tick_limit"], options.get("cache"), options["memory"])
+        for case, result in zip(cases, results):
+            assert result["name"] == case["name"]
+            assert {name: result[name] for name in expected} == expected
+
+
+def _simd_main(target, input_name):
+    # Две одинаковые дорожки: они не должны влиять друг на друга
+    first, second = simd_sim.run_inputs(target, [input_name, input_name])
+    assert first == second
+    for i in first["output"] + first["ports"][0] + first["ports"][1]:
+        print(simd_sim.render_value(i), end="")
+    print(f"\n\nTick count: {first['tick_count']}, Command count: {first['cmd_count']}")
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_simd_machine(golden):
+    _, stdout = _run_golden(golden, machine=_simd_main)
+
+    assert stdout == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_memory_size_check(golden):
+    # Программа не помещается в память команд из одной ячейки
+    with pytest.raises(data_path.ProgramSizeError):
+        _run_golden(golden, memory={"instruct_mem_size": 1})
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_overlapped_fetch(golden):
+    _, stdout = _run_golden(golden, fetch={"overlap": True, "flush_penalty": 1})
+
+    result, report = stdout.rsplit("\n", 2)[:2]
+    output, counts = result.rsplit("Tick count: ", 1)
+    expected_output, expected_counts = golden.out["out_stdout"].rsplit("Tick count: ", 1)
+    assert output == expected_output
+    # Перекрытая выборка экономит два такта, неверно предсказанный переход стоит такт сброса
+    stats = dict(i.split(": ") for i in report.split("): ")[1].split(", "))
+    ticks = int(expected_counts.split(",")[0]) - int(stats["saved_ticks"]) + int(stats["flush_ticks"])
+    assert counts.split(",")[0] == str(ticks)
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_merged_microcode(golden, caplog):
+    caplog.set_level(logging.DEBUG)
+
+    _, stdout = _run_golden(golden, merge_microcode=True)
+
+    # Журнал и вывод не меняются, такты считаются по объединённому ПЗУ микрокоманд
+    assert caplog.text == golden.out["out_log"]
+    output, ticks = stdout.rsplit("Tick count: ", 1)
+    assert output == golden.out["out_stdout"].rsplit("Tick count: ", 1)[0]
+    _, fast_stdout = _run_golden(golden, machine=fast_machine.main, merge_microcode=True)
+    assert fast_stdout == stdout
+    assert int(ticks.split(",")[0]) < int(golden.out["out_stdout"].rsplit("Tick count: ", 1)[1].split(",")[0])
+
+
+@pytest.mark.parametrize("merge", [False, True])
+def test_microcode_disk_cache(merge, tmp_path, monkeypatch):
+    # Кеш процесса пустой, чтобы generate_mc шёл к файлам во временной папке
+    monkeypatch.setattr(mc_generator, "_mc_cache", dict())
+    fresh_rom, fresh_start_ids = mc_generator.compile_mc(merge)
+
+    # Первый вызов компилирует и сохраняет .npz
+    digest = mc_generator.source_digest(merge)
+    assert mc_generator.generate_mc(tmp_path, merge) == (fresh_rom.tolist(), fresh_start_ids)
+    assert [i.name for i in tmp_path.iterdir()] == [mc_generator._cache_file(tmp_path, digest).name]
+
+    # Второй вызов загружает файл, не компилируя
+    monkeypatch.setattr(mc_generator, "_mc_cache", dict())
+    with monkeypatch.context() as m:
+        m.setattr(mc_generator, "compile_mc", lambda merge=False: pytest.fail("the cached ROM was compiled again"))
+        assert mc_generator.generate_mc(tmp_path, merge) == (fresh_rom.tolist(), fresh_start_ids)
+
+    # Изменённая таблица даёт новый хеш и новый файл
+    mc_generator.source_digest.cache_clear()
+    try:
+        monkeypatch.setattr(mc_generator, "bit_dict", {**mc_generator.bit_dict, "UNUSED": len(mc_generator.bit_dict)})
+        changed = mc_generator.source_digest(merge)
+        mc_generator.generate_mc(tmp_path, merge)
+    finally:
+        mc_generator.source_digest.cache_clear()
+    assert changed != digest
+    assert mc_generator._cache_file(tmp_path, changed).exists()
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+@pytest.mark.golden_test("golden/multicore/*.yml")
+def test_multicore(golden):
+    # Два ядра увеличивают общий счётчик под блокировкой на xchg
+    _, stdout = _run_golden(golden, machine=multicore.main)
+
+    assert stdout == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_multicore_single_core(golden):
+    # Одно ядро считает такты так же, как ControlUnit
+    _, stdout = _run_golden(golden, machine=functools.partial(multicore.main, cores=1))
+
+    output, counts = golden.out["out_stdout"].rsplit("\n\nTick count: ", 1)
+    assert stdout.startswith(f"Core 0: {output!r}, ")
+    assert stdout.endswith(f"\n\nTick count: {counts}")
+
+
+@pytest.mark.golden_test("golden/interrupts/*.yml")
+def test_interrupts(golden, tmp_path):
+    # Токены приходят в порт по расписанию, обработчик прерывания выводит их, пока процессор ждёт на hlt
+    schedule = tmp_path / "schedule.json"
+    schedule.write_text(golden["in_schedule"], encoding="utf-8")
+
+    _, stdout = _run_golden(golden, schedule=schedule)
+
+    assert stdout == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/interrupts/*.yml")
+def test_interrupts_skip_wait(golden, tmp_path, monkeypatch):
+    schedule = tmp_path / "schedule.json"
+    schedule.write_text(golden["in_schedule"], encoding="utf-8")
+
+    # Лимит тиков ровно на приходе токена, на такт раньше и на такт позже
+    arrivals = [event[0] for event in json.loads(golden["in_schedule"])]
+    tick_limits = [limit for tick in arrivals for limit in [tick - 1, tick, tick + 1]] + [control_unit.TICK_LIMIT]
+    skipped = [_run_golden(golden, schedule=schedule, tick_limit=limit)[1] for limit in tick_limits]
+
+    # Ожидание такт за тактом: пропуск не должен менять тики, команды, вывод и счётчики контроллера
+    monkeypatch.setattr(interrupts.InterruptController, "skip_wait", lambda self, tick, tick_limit: tick)
+    waited = [_run_golden(golden, schedule=schedule, tick_limit=limit)[1] for limit in tick_limits]
+
+    assert skipped == waited
+    assert skipped[-1] == golden.out["out_stdout"]
@@ -0,0 +1,181 @@
+"""
+Interrupt controller of the input ports.
+
+A schedule gives the tick each token arrives at an input port: a token which
+arrives at tick T can be read by the microinstruction of tick T or later. The
+scheduled ports get their input from the schedule only. The controller is a
+ControlUnit observer: after every tick it moves the arrived tokens into the
+port buffers.
+
+- Reading a scheduled port with no token yet does not stop the machine while
+  more tokens are scheduled: the microinstruction waits and runs again on the
+  next tick.
+- A scheduled port with a token in its buffer requests an interrupt until the
+  buffer is read empty. Interrupts are disabled on reset, `ei` enables them.
+  A request is taken when an instruction is decoded: the INT microcode block
+  runs in its place, saves its address (the next one for `hlt`), disables
+  interrupts and jumps to the vector of the port, instruction 1 for port 1
+  and instruction 2 for port 2. Instruction 0 is the reset vector, so such a
+  program starts with `jmp start` and two jumps to the handlers.
+- `iret` jumps back to the saved address and enables interrupts. A handler
+  saves acc itself if it needs to, a `load` of it restores Z as well.
+- `hlt` with interrupts enabled waits for the next token instead of stopping
+  while more tokens are scheduled.
+
+Nothing changes while the machine waits, so ControlUnit skips the waiting
+ticks up to the next arrival at once (see skip_wait); tick counts are the
+same as when waiting tick by tick.
+
+Latency of a token is the number of ticks from its arrival to its read.
+"""
+
+import json
+from collections import deque
+
+from streams import char_value
+
+# Instruction address of the handler jump of each port
+INTERRUPT_VECTORS = {1: 1, 2: 2}
+
+STAT_NAMES = ["interrupts", "wait_ticks", "tokens_read"]
+
+
+class ScheduleError(Exception):
+    def __init__(self, event):
+        super().__init__(f"Bad schedule event {event!r}, expected [tick, port (1 or 2), token (number or character)]")
+
+
+class ScheduledPort:
+    """
+    Input buffer of a port fed by the schedule, used as DataPath.ports[i]["in"]
+    """
+
+    def __init__(self, controller, events):
+        self.controller = controller
+        self.scheduled = deque(sorted(events, key=lambda event: event[0]))
+        # (arrival tick, token)
+        self.arrived = deque()
+
+    def __len__(self):
+        return len(self.arrived)
+
+    def popleft(self):
+        arrival, token = self.arrived.popleft()
+        self.controller.token_read(arrival)
+        return token
+
+    def deliver(self, tick):
+        while self.scheduled and self.scheduled[0][0] <= tick:
+            self.arrived.append(self.scheduled.popleft())
+
+    def next_arrival(self):
+        return self.scheduled[0][0] if self.scheduled else None
+
+
+class InterruptController:
+    def __init__(self, schedule):
+        """
+        `schedule` is a list of (tick, port, token) events
+        """
+        events = {port: list() for port in sorted({event[1] for event in schedule})}
+        for tick, port, token in schedule:
+            events[port].append((tick, token))
+        self.ports = {port: ScheduledPort(self, port_events) for port, port_events in events.items()}
+        self.total_tokens = len(schedule)
+        self.tick = 0
+        self.next_arrival = self._next_arrival()
+        self.stats = dict.fromkeys(STAT_NAMES, 0)
+        self.latencies = list()
+
+    def install(self, dp):
+        dp.interrupts = self
+        for port, buffer in self.ports.items():
+            dp.ports[port - 1]["in"] = buffer
+
+    def request(self):
+        """
+        Vector of the first port with a token in its buffer, None without requests
+        """
+        for port, buffer in self.ports.items():
+            if buffer.arrived:
+                return INTERRUPT_VECTORS[port]
+        return None
+
+    def wait(self, port=None):
+        """
+        True (and the tick is counted as waiting) if a token is still scheduled for `port`, any port without it
+        """
+        if port is None:
+            ports = self.ports.values()
+        else:
+            ports = [self.ports[port]] if port in self.ports else []
+        if any(buffer.scheduled for buffer in ports):
+            self.stats["wait_ticks"] += 1
+            return True
+        return False
+
+    def skip_wait(self, tick, tick_limit):
+        """
+        Tick a wait which took `tick` continues from: the one before the next arrival, at most the first one over
+        `tick_limit`. The skipped ticks are counted as waiting.
+        """
+        if self.next_arrival is None:
+            return tick
+        target = min(self.next_arrival - 1, int(tick_limit) + 1)
+        if target <= tick:
+            return tick
+        self.stats["wait_ticks"] += target - tick
+        return target
+
+    def token_read(self, arrival):
+        # the read is done by the microinstruction of the next tick
+        self.stats["tokens_read"] += 1
+        self.latencies.append(self.tick + 1 - arrival)
+
+    def _next_arrival(self):
+        arrivals = [i for i in (buffer.next_arrival() for buffer in self.ports.values()) if i is not None]
+        return min(arrivals, default=None)
+
+    def _deliver(self, tick):
+        self.tick = tick
+        if self.next_arrival is not None and self.next_arrival <= tick + 1:
+            for buffer in self.ports.values():
+                buffer.deliver(tick + 1)
+            self.next_arrival = self._next_arrival()
+
+    # ControlUnit observer
+
+    def record_reset(self, dp, tick=0):
+        self._deliver(tick)
+
+    def record(self, tick, mc_ip, dp):
+        self._deliver(tick)
+
+    def stop(self, halt_reason, mc_ip):
+        pass
+
+    def report(self, tick_count):
+        counters = ", ".join(f"{name}: {self.stats[name]}" for name in STAT_NAMES)
+        text = f"Interrupts: {counters} of {self.total_tokens} tokens"
+        if self.latencies:
+            mean = sum(self.latencies) / len(self.latencies)
+            text += f", latency mean: {mean:.1f}, max: {max(self.latencies)} ticks"
+        if tick_count > 0:
+            text += f", throughput: {self.stats['tokens_read'] * 1000 / tick_count:.2f} tokens per 1000 ticks"
+        return text
+
+
+def load_schedule(filename):
+    """
+    Schedule from a JSON list of [tick, port, token] events; a token is a number or a character,
+    decoded as in the input file (see char_value)
+    """
+    with open(filename, encoding="utf-8") as f:
+        events = json.load(f)
+    schedule = list()
+    for event in events:
+        if len(event) != 3 or event[1] not in INTERRUPT_VECTORS or (isinstance(event[2], str) and len(event[2]) != 1):
+            raise ScheduleError(event)
+        tick, port, token = event
+        schedule.append((tick, port, char_value(token) if isinstance(token, str) else token))
+    return schedule
@@ -34,13 +34,13 @@ class Opcode(StrEnum):
     PORT2_OUT = "port2_out"
     PORT2_IN = "port2_in"
 
+    XCHG = "xchg"  # atomic exchange of acc and a memory cell
 
-def code_to_operation(op_id: int):
-    return opcode_list[op_id // 10], address_list[op_id % 10]
-
+    EI = "ei"  # interrupts, see interrupts.py
+    DI = "di"
+    IRET = "iret"
 
-def operation_to_code(operation: Opcode, address: Address):
-    return opcode_list.index(operation) * 10 + address_list.index(address)
+    INT = "int"  # interrupt entry: the decoder puts it in place of the fetched instruction, not in allowed_addressing
 
 
 opcode_list = [
@@ -61,6 +61,11 @@ opcode_list = [
     Opcode.PORT2_OUT,
     Opcode.PORT1_IN,
     Opcode.PORT2_IN,
+    Opcode.XCHG,
+    Opcode.EI,
+    Opcode.DI,
+    Opcode.IRET,
+    Opcode.INT,
 ]
 
 address_list = [
@@ -89,4 +94,24 @@ allowed_addressing = {
     Opcode.SUB: [Address.LABEL_VAL, Address.DIRECT],
     Opcode.JMP: [Address.LABEL_VAL],
     Opcode.JMPZ: [Address.LABEL_VAL],
+    Opcode.XCHG: [Address.LABEL_VAL, Address.INDIRECT],
+    Opcode.EI: [Address.NO_OP],
+    Opcode.DI: [Address.NO_OP],
+    Opcode.IRET: [Address.NO_OP],
 }
+
+# Decode tables, built once: instruction code -> (opcode, address type) and back
+code_table = {
+    opcode_id * 10 + address_id: (opcode, address)
+    for opcode_id, opcode in enumerate(opcode_list)
+    for address_id, address in enumerate(address_list)
+}
+operation_table = {operation: code for code, operation in code_table.items()}
+
+
+def code_to_operation(op_id: int):
+    return code_table[op_id]
+
+
+def operation_to_code(operation: Opcode, address: Address):
+    return operation_table[operation, address]
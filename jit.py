@@ -0,0 +1,190 @@
+"""
+Trace compiler of hot loops.
+
+ControlUnit calls TraceJit on instruction boundaries, right before the first
+microinstruction of the fetch. Targets of backward jumps are loop heads; once
+a head is reached `threshold` times, the straight-line code from it up to the
+jump back is compiled into a Python function which runs whole loop iterations
+on acc, Z, ADDR and data memory and adds the tick cost of the instructions,
+taken from the microcode ROM. The trace leaves on a jump out of the loop and
+before I/O and `hlt`, which the microcode runs as usual, and it never starts an
+iteration which could cross the tick limit, so ticks, command counts and
+results are the same as without it.
+"""
+
+from isa import Address, Opcode, code_to_operation
+from mc_generator import tick_costs
+
+HOT_THRESHOLD = 16
+
+MAX_TRACE_LEN = 64
+
+# Instructions the trace leaves to the microcode
+EXIT_OPCODES = [
+    Opcode.INPUT,
+    Opcode.OUTPUT,
+    Opcode.PORT1_IN,
+    Opcode.PORT1_OUT,
+    Opcode.PORT2_IN,
+    Opcode.PORT2_OUT,
+    Opcode.HLT,
+    Opcode.EI,
+    Opcode.DI,
+    Opcode.IRET,
+]
+
+ALU_EXPR = {
+    Opcode.INC: "acc + 1",
+    Opcode.DEC: "acc - 1",
+    Opcode.CLS: "0",
+    Opcode.NEG: "-acc",
+    Opcode.ADD: "acc + {}",
+    Opcode.SUB: "acc - {}",
+    Opcode.LOAD: "{}",
+}
+
+
+def _operand(addr_type, arg, lines, mem_size, leave):
+    """
+    Expression of the operand; lines latching ADDR are appended to `lines`. An indirect address
+    outside the `mem_size` cells runs `leave`, so the microcode executes the instruction and reports it.
+    """
+    if addr_type == Address.LABEL_VAL:
+        lines.append(f"addr = {arg}")
+        return "mem[addr]"
+    if addr_type == Address.INDIRECT:
+        lines.append(f"target = mem[{arg}]")
+        lines.append(f"if not 0 <= target < {mem_size}:")
+        lines.append(f"    {leave}")
+        lines.append("addr = target")
+        return "mem[addr]"
+    return str(arg)
+
+
+class TraceJit:
+    def __init__(self, dp, mc_mem, start_ids, threshold=HOT_THRESHOLD):
+        self.dp = dp
+        self.threshold = threshold
+        self.costs = tick_costs(mc_mem, start_ids)[0]
+
+        self.heads = dict()
+        for addr, (code, arg) in enumerate(zip(dp.instr_codes, dp.instr_args)):
+            if code_to_operation(code)[0] in [Opcode.JMP, Opcode.JMPZ] and arg <= addr:
+                self.heads[arg] = 0
+        # head -> compiled function, or None if the loop can't be compiled
+        self.traces = dict()
+        self.sources = dict()
+
+    def run(self, cu, tick, tick_limit):
+        """
+        Run compiled loops from the next instruction while possible, return the new tick
+        """
+        dp = self.dp
+        ip = dp.signals_dict["MUX_ip"][dp.mux_ip_i]
+        while True:
+            trace = self.traces.get(ip) if ip in self.traces else self._count(ip)
+            if trace is None:
+                return tick
+            next_ip, last_ip, acc, flag_z, addr, ticks, cmds = trace(
+                dp.acc, dp.flag_z, dp.reg_addr, dp.data_mem, tick_limit - tick
+            )
+            if cmds == 0:
+                return tick
+            tick += ticks
+            cu.cmd_count += cmds
+            self._exit(next_ip, last_ip, acc, flag_z, addr)
+            ip = next_ip
+
+    def _count(self, ip):
+        if ip not in self.heads:
+            return None
+        self.heads[ip] += 1
+        if self.heads[ip] < self.threshold:
+            return None
+        self.traces[ip] = self._compile(ip)
+        return self.traces[ip]
+
+    def _exit(self, next_ip, last_ip, acc, flag_z, addr):
+        """
+        Put the DataPath into the state it has after `last_ip`, with `next_ip` to be fetched
+        """
+        dp = self.dp
+        signals = dp.signals_dict
+        dp.acc = signals["acc"] = signals["data_mem_input"] = signals["MUX_ALU"][1] = acc
+        dp.flag_z = signals["z"] = flag_z
+        signals["MUX_jmp_type"][1] = 1 - flag_z
+        dp.reg_addr = signals["reg_addr"] = addr
+        dp.reg_ip = signals["reg_ip"] = last_ip
+        dp.reg_ir = signals["reg_ir"] = signals["ALU_instr"] = dp.instr_codes[last_ip]
+        signals["MUX_ip"][0] = next_ip
+        dp.mux_ip_i = 0
+
+    def _compile(self, head):
+        body = self._trace_body(head)
+        if body is None:
+            return None
+        lines, iteration_ticks, back_ip = body
+        source = "\n".join(
+            [
+                "def trace(acc, z, addr, mem, budget):",
+                "    ticks = cmds = 0",
+                f"    while ticks + {iteration_ticks} <= budget:",
+                *("        " + i for i in lines),
+                f"    return {head}, {back_ip}, acc, z, addr, ticks, cmds",
+            ]
+        )
+        namespace = dict()
+        exec(compile(source, f"<trace {head}>", "exec"), namespace)
+        self.sources[head] = source
+        return namespace["trace"]
+
+    def _trace_body(self, head):  # noqa: C901
+        """
+        Lines of one loop iteration, its tick cost and the address of the jump back,
+        or None for loops which can't be compiled
+        """
+        lines = list()
+        ticks = count = 0
+        ip = head
+        while count < MAX_TRACE_LEN:
+            code, arg = self.dp.instr_codes[ip], self.dp.instr_args[ip]
+            opcode, addr_type = code_to_operation(code)
+            if opcode in EXIT_OPCODES:
+                if count == 0:
+                    return None
+                lines.append(f"return {ip}, {ip - 1}, acc, z, addr, ticks + {ticks}, cmds + {count}")
+                return lines, ticks, ip
+            # leaving before the instruction; at the head the state is the one after the previous iteration.
+            # Jumps fetch their operand too: the target is latched into ADDR, as the microcode does
+            leave = f"return {ip}, {ip - 1}, acc, z, addr, ticks + {ticks}, cmds + {count}" if count else "break"
+            operand = _operand(addr_type, arg, lines, self.dp.data_mem_size, leave)
+            ticks += self.costs[code]
+            count += 1
+
+            if opcode == Opcode.STORE:
+                lines.append(f"{operand} = acc")
+            elif opcode == Opcode.XCHG:
+                lines.append(f"acc, {operand} = {operand}, acc")
+                lines.append("z = acc == 0")
+            elif opcode in ALU_EXPR:
+                lines.append(f"acc = {ALU_EXPR[opcode].format(operand)}")
+                lines.append("z = acc == 0")
+            elif opcode == Opcode.JMP:
+                if arg == head:
+                    lines.append(f"ticks += {ticks}")
+                    lines.append(f"cmds += {count}")
+                    return lines, ticks, ip
+                lines.append(f"return {arg}, {ip}, acc, z, addr, ticks + {ticks}, cmds + {count}")
+                return lines, ticks, ip
+            elif opcode == Opcode.JMPZ:
+                exit_ip = ip + 1 if arg == head else arg
+                lines.append(f"if {'not ' if arg == head else ''}z:")
+                lines.append(f"    return {exit_ip}, {ip}, acc, z, addr, ticks + {ticks}, cmds + {count}")
+                if arg == head:
+                    lines.append(f"ticks += {ticks}")
+                    lines.append(f"cmds += {count}")
+                    return lines, ticks, ip
+            ip += 1
+
+        lines.append(f"return {ip}, {ip - 1}, acc, z, addr, ticks + {ticks}, cmds + {count}")
+        return lines, ticks, ip
@@ -0,0 +1,103 @@
+"""
+Compact binary format of translated programs.
+
+Layout (little-endian):
+    header   magic "ZAMC", version u16, flags u16, code size u32, data size u32, debug size u32
+    code     instruction codes, u16 per instruction
+             instruction arguments, i64 per instruction
+    data     initial data memory image, i64 per cell
+    debug    optional UTF-8 JSON with source terms of instructions and data
+
+JSON output of the translator stays the debug format; the binary one is loaded
+straight into DataPath arrays without building per-instruction dicts.
+"""
+
+import json
+import mmap
+import struct
+from array import array
+
+MAGIC = b"ZAMC"
+VERSION = 1
+FLAG_DEBUG = 1
+
+HEADER = struct.Struct("<4sHHIII")
+
+
+class InvalidBinaryError(Exception):
+    def __init__(self, filename, reason):
+        super().__init__(f'Invalid binary program "{filename}": {reason}')
+
+
+def data_to_mem(data):
+    """
+    Flatten translated data records into a memory image: every record longer
+    than one cell is prefixed with its size
+    """
+    mem_list = list()
+    for i in data:
+        if i["size"] != 1:
+            mem_list.append(i["size"])
+        mem_list += i["init"]
+    return mem_list
+
+
+def _to_word(cell):
+    """
+    The translator keeps bare data values like `0` as characters; they are
+    stored the way input characters are: digits by value, others by code
+    """
+    if isinstance(cell, str):
+        return int(cell) if cell.isdigit() else ord(cell)
+    return cell
+
+
+def is_binary(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_binary(target, codes, args, mem_list, debug=None):
+    debug_bytes = b"" if debug is None else json.dumps(debug).encode()
+    flags = 0 if debug is None else FLAG_DEBUG
+
+    with open(target, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, flags, len(codes), len(mem_list), len(debug_bytes)))
+        f.write(array("H", codes).tobytes())
+        f.write(array("q", args).tobytes())
+        f.write(array("q", [_to_word(i) for i in mem_list]).tobytes())
+        f.write(debug_bytes)
+
+
+def read_binary(filename, with_debug=False):
+    """
+    Map a binary program into memory and return arrays of instruction codes,
+    instruction arguments and the data memory image, plus the debug section
+    if it is requested and present
+    """
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if len(mm) < HEADER.size:
+            raise InvalidBinaryError(filename, "truncated header")
+        magic, version, flags, code_size, data_size, debug_size = HEADER.unpack_from(mm)
+        if magic != MAGIC or version != VERSION:
+            raise InvalidBinaryError(filename, f"expected version {VERSION} header")
+
+        offset = HEADER.size
+        codes, offset = _read_array(filename, mm, offset, "H", code_size)
+        args, offset = _read_array(filename, mm, offset, "q", code_size)
+        mem, offset = _read_array(filename, mm, offset, "q", data_size)
+
+        debug = None
+        if with_debug and flags & FLAG_DEBUG:
+            debug = json.loads(mm[offset : offset + debug_size].decode())
+
+    return codes, args, mem, debug
+
+
+def _read_array(filename, mm, offset, typecode, size):
+    res = array(typecode)
+    end = offset + res.itemsize * size
+    if end > len(mm):
+        raise InvalidBinaryError(filename, "truncated program segment")
+    res.frombytes(mm[offset:end])
+    return res, end
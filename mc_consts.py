@@ -25,6 +25,7 @@ bit_dict = {
     "M_IM": 16,
     "PORT1_OUT": 17,
     "PORT2_OUT": 18,
+    "INT_CTL": 19,  # interrupt control, the value selects the operation
 }
 
 bit_dict["M_MUX_IP_2"] = -2
@@ -32,12 +33,20 @@ bit_dict["M_MUX_IP_2"] = -2
 bit_dict["PORT1_IN"] = bit_dict["MUX_ALU_INPUT"]
 bit_dict["PORT2_IN"] = bit_dict["MUX_ALU_INPUT"]
 
+INT_CTL_VALUES = {"EI": 1, "DI": 2, "IRET": 3, "INT": 4}
+for name in INT_CTL_VALUES:
+    bit_dict[name] = bit_dict["INT_CTL"]
+
 bit_dict["MUX_ADDR_S"] = bit_dict["MUX_ADDR"]
 bit_dict["MUX_ALU_S"] = bit_dict["MUX_ALU"]
 bit_dict["MUX_ALU_INPUT_S"] = bit_dict["MUX_ALU_INPUT"]
 # -5 - don't change
 SKIP_LIST = ["MUX_ADDR_S", "MUX_ALU_S", "MUX_ALU_INPUT_S"]
 
+# Multiplexer selectors are applied on every tick, even when their bit is 0.
+# All other bits are strobes and do nothing while inactive.
+MUX_LIST = ["MUX_IP", "MUX_JMP_TYPE", "MUX_ADDR", "MUX_ALU", "MUX_ALU_INPUT", "M_MUX_IP"]
+
 
 def get_line_len():
     return max(bit_dict.values()) + 1
@@ -70,6 +79,18 @@ PORT2_OUT = [["PORT2_OUT"]]
 
 HLT = []
 
+# the old value of the cell is on the ALU input after addressing, acc is on the memory input
+XCHG = [["DIN"], ["ALU"], ["ACC"]]
+
+EI = [["EI"]]
+DI = [["DI"]]
+
+# the return address goes to MUX_ip[0], the jump input of the IP multiplexer
+IRET = [["IRET"]]
+
+# interrupt entry: saves the return address and puts the vector on the jump input
+INT = [["INT"]]
+
 op_dict = {
     "Start": START.copy(),
     Opcode.INC: ALU_OPERATION.copy(),
@@ -89,6 +110,11 @@ op_dict = {
     Opcode.PORT2_IN: PORT2_IN.copy(),
     Opcode.PORT1_OUT: PORT1_OUT.copy(),
     Opcode.PORT2_OUT: PORT2_OUT.copy(),
+    Opcode.XCHG: XCHG.copy(),
+    Opcode.EI: EI.copy(),
+    Opcode.DI: DI.copy(),
+    Opcode.IRET: IRET.copy(),
+    Opcode.INT: INT.copy(),
 }
 
 #  Address implementation
@@ -122,7 +148,7 @@ for name, operation in op_dict.items():
     for i in range(len(operation)):
         if i != len(operation) - 1:
             operation[i] += ["M_MUX_IP"]
-        elif name not in ["Start", Opcode.JMP, Opcode.JMPZ]:
+        elif name not in ["Start", Opcode.JMP, Opcode.JMPZ, Opcode.IRET, Opcode.INT]:
             operation[i] += ["MUX_IP"]
         operation[i] += ["M_IP", "M_IM"]
         if name not in [Opcode.INPUT, "Start"]:
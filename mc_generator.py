@@ -1,22 +1,167 @@
+"""
+Microcode compiler.
+
+`compile_mc` builds the microcode ROM from the symbolic tables of mc_consts,
+optionally with independent microsteps merged (see mc_optimizer.py).
+`generate_mc` returns a ready ROM: compiled tables are cached in the process and
+on disk (`.mc_cache`, one NumPy archive per version of the tables), keyed by a
+hash of everything the ROM is built from, so editing mc_consts or isa
+invalidates the cache. The cached ROM is shared, callers must not modify it.
+"""
+
 from __future__ import annotations
 
-from typing import Any
+import functools
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+import mc_consts
+import numpy as np
+from isa import Address, Opcode, allowed_addressing, code_to_operation, operation_to_code
+from mc_consts import INT_CTL_VALUES, SKIP_LIST, START, address_dict, bit_dict, get_line_len, op_dict
+from mc_optimizer import merge_microsteps
+
+MC_VERSION = 1
+
+# version of the merging pass, part of the digest of merged ROMs
+MERGE_VERSION = 1
+
+MC_CACHE_DIR = Path(__file__).resolve().parent / ".mc_cache"
+
+_mc_cache = dict()
+
+
+@functools.cache
+def source_digest(merge=False) -> str:
+    """
+    Hash of the compiler version and every table the ROM is built from.
+    The tables are constants, so it is computed once per process.
+    """
+    sources = (MC_VERSION, START, op_dict, address_dict, bit_dict, SKIP_LIST, mc_consts.MUX_LIST, allowed_addressing)
+    sources += (INT_CTL_VALUES,)
+    if merge:
+        sources += (MERGE_VERSION,)
+    return hashlib.sha256(repr(sources).encode()).hexdigest()
+
 
-from isa import Address, Opcode, allowed_addressing, operation_to_code
-from mc_consts import SKIP_LIST, START, address_dict, bit_dict, get_line_len, op_dict
+def generate_mc(cache_dir=MC_CACHE_DIR, merge=False) -> tuple[list[list[int]], dict[int, int]]:
+    """
+    Microcode ROM (list of lines of bits) and the table of block start addresses by instruction code.
+    `merge` merges independent microsteps, which makes instructions take fewer ticks.
+    """
+    digest = source_digest(merge)
+    if digest not in _mc_cache:
+        rom, start_ids = _load_cached_mc(cache_dir, digest, merge)
+        _mc_cache[digest] = rom.tolist(), start_ids
+    return _mc_cache[digest]
 
 
-def generate_mc() -> tuple[list[Any], dict[tuple[Any, Any], int]]:
+def compile_mc(merge=False) -> tuple[np.ndarray, dict[int, int]]:
     res = list()
 
     start_ids = dict()
     res += _labels_to_bits(START)
-    for instr, addr_list in allowed_addressing.items():
+    # the interrupt entry block is decoded like an instruction
+    for instr, addr_list in [*allowed_addressing.items(), (Opcode.INT, [Address.NO_OP])]:
         for addr in addr_list:
             start_ids[operation_to_code(instr, addr)] = len(res)
             res.extend(_generate_block(instr, addr))
 
-    return res, start_ids
+    if merge:
+        res, start_ids = merge_microsteps(res, start_ids)
+    return np.array(res, dtype=np.uint8), start_ids
+
+
+def _cache_file(cache_dir, digest):
+    return Path(cache_dir) / f"mc-v{MC_VERSION}-{digest[:16]}.npz"
+
+
+def _load_cached_mc(cache_dir, digest, merge=False):
+    """
+    Load the compiled ROM from the disk cache, compiling and saving it on a miss.
+    An unusable cache directory only costs a compilation.
+    """
+    filename = _cache_file(cache_dir, digest)
+    try:
+        with np.load(filename) as archive:
+            if str(archive["digest"]) == digest:
+                return archive["rom"], dict(zip(archive["codes"].tolist(), archive["starts"].tolist()))
+    except (OSError, KeyError, ValueError):
+        pass
+
+    rom, start_ids = compile_mc(merge)
+    try:
+        _save_cached_mc(filename, digest, rom, start_ids)
+    except OSError:
+        pass
+    return rom, start_ids
+
+
+def _save_cached_mc(filename, digest, rom, start_ids):
+    # written to a temporary file first: batch workers may compile at the same time
+    filename.parent.mkdir(exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=filename.parent, suffix=".npz")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(
+            f,
+            digest=np.array(digest),
+            rom=rom,
+            codes=np.array(list(start_ids.keys())),
+            starts=np.array(list(start_ids.values())),
+        )
+    Path(tmp_name).replace(filename)
+
+
+def _block_len(mc_mem, start):
+    """
+    Number of microinstructions from `start` up to the one which returns to START
+    """
+    i = start
+    while mc_mem[i][bit_dict["M_MUX_IP"]] != 0:
+        i += 1
+    return i - start + 1
+
+
+def block_lines(mc_mem, start):
+    """
+    Microcode addresses of the block starting at `start`
+    """
+    return range(start, start + _block_len(mc_mem, start))
+
+
+def tick_costs(mc_mem, start_ids):
+    """
+    Ticks counted by ControlUnit.juggernaut for every instruction code.
+
+    Returns a pair of dicts: ticks of a completed instruction and ticks counted
+    before the instruction stops the machine (hlt or read from an empty buffer).
+    """
+    fetch_len = 0
+    while mc_mem[fetch_len][bit_dict["M_MUX_IP"]] != 2:
+        fetch_len += 1
+    fetch_len += 1
+    hlt_len = next(i for i in range(fetch_len) if mc_mem[i][bit_dict["IR"]])
+
+    costs = dict()
+    stop_costs = dict()
+    for code, start in start_ids.items():
+        if code_to_operation(code)[0] == Opcode.HLT:
+            stop_costs[code] = hlt_len
+            continue
+        block_len = _block_len(mc_mem, start)
+        costs[code] = fetch_len + block_len
+        for i in range(start, start + block_len):
+            if mc_mem[i][bit_dict["ALU"]] and mc_mem[i][bit_dict["MUX_ALU_INPUT"]]:
+                stop_costs[code] = fetch_len + i - start
+                break
+
+    return costs, stop_costs
+
+
+def rom_digest(mc_mem) -> str:
+    return hashlib.sha256(repr(mc_mem).encode()).hexdigest()
 
 
 def _generate_block(instr, addr, printed=False):
@@ -36,23 +181,28 @@ def _generate_block_symbols(instr, addr, printed=False):
 
 
 def _labels_to_bits(code: list):  # noqa: C901
+    line_len = get_line_len()
     res = list()
-    for i in range(len(code)):
-        line = [0] * get_line_len()
-        for j in code[i]:
+    for labels in code:
+        labels = set(labels)
+        line = [0] * line_len
+        for j in labels:
             bin_code = bit_dict[j]
             if bin_code >= 0:
                 line[bin_code] = 1
 
         for skip_label in SKIP_LIST:
-            if skip_label in code[i]:
+            if skip_label in labels:
                 line[bit_dict[skip_label]] = 0 if len(res) == 0 else res[-1][bit_dict[skip_label]]
-        if "M_MUX_IP_2" in code[i]:
+        if "M_MUX_IP_2" in labels:
             line[bit_dict["M_MUX_IP"]] = 2
-        if "PORT1_IN" in code[i]:
+        if "PORT1_IN" in labels:
             line[bit_dict["PORT1_IN"]] = 2
-        if "PORT2_IN" in code[i]:
+        if "PORT2_IN" in labels:
             line[bit_dict["PORT2_IN"]] = 3
+        for name, value in INT_CTL_VALUES.items():
+            if name in labels:
+                line[bit_dict["INT_CTL"]] = value
 
         res.append(line)
     return res
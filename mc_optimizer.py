@@ -0,0 +1,141 @@
+"""
+Microstep merging pass over the compiled microcode ROM.
+
+ControlUnit applies the signals of a microinstruction one by one in bit order,
+so two consecutive microinstructions can run as one when their signals are
+independent: the second does not read state the first writes (RAW), they do
+not write the same state (WAW) and the second does not overwrite state the
+first reads (WAR). Then the bit order inside the merged line does not matter
+and it ends in the same state as the pair, one tick earlier.
+
+Multiplexer selectors are applied on every tick, so the merged line takes the
+selectors of the second one; a selector read by a strobe of the first line has
+to be the same in both. A line which can stop the machine (`IR` on `hlt`, `ALU`
+reading an empty input) is only merged with a line without strobes, so the
+machine stops in the same state. Lines entered from the sequencer (START and
+the first line of every block) are never merged into the previous line.
+"""
+
+from isa import Opcode, code_to_operation
+from mc_consts import bit_dict
+
+# Strobes: state they read and state they write, see the DataPath signals
+STROBES = {
+    "IP": ({"mux_ip_i", "MUX_ip"}, {"reg_ip", "MUX_ip"}),
+    "IM": ({"reg_ip"}, {"sig_reg_ir", "ALU_instr", "MUX_addr1", "MUX_ip", "MUX_ALU0"}),
+    "IR": ({"sig_reg_ir", "interrupt_enable"}, {"reg_ir", "int_return", "int_vector"}),
+    "ADDR": (set(), {"reg_addr"}),
+    "ALU": ({"ALU_instr", "acc"}, {"sig_acc"}),
+    "ACC": ({"sig_acc"}, {"acc", "flag_z", "MUX_ALU1", "data_mem_input"}),
+    "OUTPUT": ({"acc"}, {"output"}),
+    "DIN": ({"reg_addr", "data_mem_input"}, {"data_mem"}),
+    "DOUT": ({"reg_addr", "data_mem"}, {"MUX_addr0", "MUX_ALU1"}),
+    "PORT1_OUT": ({"acc"}, {"port1_out"}),
+    "PORT2_OUT": ({"acc"}, {"port2_out"}),
+    "INT_CTL": ({"saved_ip", "int_return", "int_vector"}, {"MUX_ip", "saved_ip", "interrupt_enable"}),
+}
+
+# Selectors read by a strobe of the same microinstruction
+SELECTOR_READERS = {
+    "MUX_ADDR": "ADDR",
+    "MUX_ALU": "ALU",
+    "MUX_ALU_INPUT": "ALU",
+}
+
+SELECTORS = ["MUX_IP", "MUX_JMP_TYPE", "MUX_ADDR", "MUX_ALU", "MUX_ALU_INPUT"]
+
+SEQUENCER = ["M_MUX_IP", "M_IP", "M_IM"]
+
+
+def _strobes(line):
+    return [name for name in STROBES if line[bit_dict[name]]]
+
+
+def _effects(line):
+    """
+    State read and written by the strobes of `line`
+    """
+    reads, writes = set(), set()
+    for name in _strobes(line):
+        reads |= STROBES[name][0]
+        writes |= STROBES[name][1]
+    if line[bit_dict["ADDR"]]:
+        reads.add(f"MUX_addr{line[bit_dict['MUX_ADDR']]}")
+    if line[bit_dict["ALU"]]:
+        mux_input = line[bit_dict["MUX_ALU_INPUT"]]
+        reads.add(f"MUX_ALU{line[bit_dict['MUX_ALU']]}" if mux_input == 0 else f"input{mux_input}")
+        if mux_input != 0:
+            writes.add(f"input{mux_input}")
+    if line[bit_dict["MUX_JMP_TYPE"]]:
+        # the conditional jump selects the next IP by the Z flag
+        reads.add("flag_z")
+    if line[bit_dict["M_MUX_IP"]] == 2:
+        reads.add("reg_ir")
+    # the IP latch of the next line reads the jump selector of this one
+    writes.add("mux_ip_i")
+    return reads, writes
+
+
+def _can_stop(line):
+    return line[bit_dict["IR"]] or (line[bit_dict["ALU"]] and line[bit_dict["MUX_ALU_INPUT"]])
+
+
+def can_merge(first, second):
+    """
+    True if microinstruction `second`, which runs right after `first`, can run on the same tick
+    """
+    if first[bit_dict["M_MUX_IP"]] != 1:
+        return False
+    first_reads, first_writes = _effects(first)
+    second_reads, second_writes = _effects(second)
+    second_writes.discard("mux_ip_i")
+    if second_reads & first_writes or second_writes & (first_writes | first_reads):
+        return False
+
+    for selector, reader in SELECTOR_READERS.items():
+        if first[bit_dict[reader]] and first[bit_dict[selector]] != second[bit_dict[selector]]:
+            return False
+
+    if (_can_stop(first) and _strobes(second)) or (_can_stop(second) and _strobes(first)):
+        return False
+    return True
+
+
+def merge_lines(first, second):
+    line = [a | b for a, b in zip(first, second)]
+    for name in SELECTORS + SEQUENCER:
+        line[bit_dict[name]] = second[bit_dict[name]]
+    return line
+
+
+def merge_microsteps(rom, start_ids):
+    """
+    ROM with independent consecutive microinstructions merged, and the new block start addresses
+    """
+    entries = {0, *start_ids.values()}
+    res = list()
+    new_address = list()
+    for i, line in enumerate(rom):
+        if res and i not in entries and can_merge(res[-1], line):
+            res[-1] = merge_lines(res[-1], line)
+        else:
+            res.append(list(line))
+        new_address.append(len(res) - 1)
+    # an empty block (hlt) may start right after the end of the ROM
+    new_address.append(len(res))
+
+    return res, {code: new_address[start] for code, start in start_ids.items()}
+
+
+if __name__ == "__main__":
+    from mc_generator import generate_mc, tick_costs
+
+    rom, start_ids = generate_mc()
+    merged_rom, merged_ids = generate_mc(merge=True)
+    costs = tick_costs(rom, start_ids)[0]
+    merged_costs = tick_costs(merged_rom, merged_ids)[0]
+    print(f"ROM: {len(rom)} -> {len(merged_rom)} microinstructions")
+    for code, cost in costs.items():
+        opcode, addr = code_to_operation(code)
+        if opcode != Opcode.HLT and merged_costs[code] != cost:
+            print(f"  {opcode.name} {addr.name}: {cost} -> {merged_costs[code]} ticks")
@@ -0,0 +1,197 @@
+"""
+Multi-core machine.
+
+MultiCore runs several ControlUnit + DataPath pairs of one program in lockstep.
+The cores share the data memory (one object in every DataPath) and have their
+own registers, microcode sequencers and I/O buffers, each with its own copy of
+the input. On reset core k has k in acc, so the program can tell the cores
+apart. On every tick each running core executes one microinstruction; the
+order of the cores rotates from tick to tick, so none of them always wins.
+
+`xchg` is atomic: a core running its microcode block holds the memory bus, and
+the other cores wait before any microinstruction which reads or writes the
+data memory (`DIN`, `DOUT`) until the instruction is complete. A spinlock is
+`load 0x1` + `xchg lock` + `jmpz` to the critical section.
+
+With a data cache every core gets its own Cache, kept coherent by snooping
+(write-invalidate): a write drops the line from the other caches, and a read
+or write of a line dirty in another cache waits for its write back.
+"""
+
+import argparse
+
+from cache import Cache, add_cache_arguments, cache_config
+from control_unit import TICK_LIMIT, ControlUnit, load_data_path
+from data_path import (
+    EmptyBufferError,
+    HltError,
+    add_memory_arguments,
+    memory_config,
+    render_value,
+)
+from isa import Opcode, code_to_operation
+from mc_consts import bit_dict
+from mc_generator import block_lines, generate_mc
+
+CORE_STATS = ["ticks", "commands", "stall_ticks", "wait_ticks"]
+BUS_STATS = ["lock_transfers", "invalidations", "coherence_writebacks"]
+
+
+class CoherentCache:
+    """
+    Cache of one core on the bus, used as DataPath.cache
+    """
+
+    def __init__(self, bus, core, cache):
+        self.bus = bus
+        self.core = core
+        self.cache = cache
+        self.stats = cache.stats
+
+    def access(self, addr, write=False):
+        return self.cache.access(addr, write) + self.bus.snoop(self.core, addr, write)
+
+    def report(self):
+        return self.cache.report()
+
+
+class Bus:
+    """
+    Owner of the `xchg` lock and the snooping of the per-core caches
+    """
+
+    def __init__(self, caches):
+        self.caches = caches
+        self.owner = None
+        self.stats = dict.fromkeys(BUS_STATS, 0)
+
+    def snoop(self, core, addr, write):
+        """
+        Stall ticks of the other caches writing the line back
+        """
+        stall = 0
+        for i, cache in enumerate(self.caches):
+            if i == core:
+                continue
+            held, dirty = cache.snoop(addr, write)
+            if held and write:
+                self.stats["invalidations"] += 1
+            if dirty:
+                self.stats["coherence_writebacks"] += 1
+                stall += cache.memory_latency
+        return stall
+
+
+class MultiCore:
+    def __init__(self, program_name, input_name, cores=2, memory=None, cache=None, microcode=None):
+        """
+        `memory` and `cache` are the parameters of control_unit.main, every core gets its own cache
+        """
+        self.microcode = generate_mc() if microcode is None else microcode
+        self.dps = [load_data_path(program_name, input_name, memory=memory) for _ in range(cores)]
+        shared = self.dps[0].data_mem
+        for core, dp in enumerate(self.dps):
+            dp.data_mem = shared
+            dp.acc = dp.signals_dict["acc"] = dp.signals_dict["data_mem_input"] = core
+            dp.signals_dict["MUX_ALU"][1] = core
+
+        self.bus = Bus([] if cache is None else [Cache(**cache) for _ in range(cores)])
+        for core, cache_model in enumerate(self.bus.caches):
+            self.dps[core].cache = CoherentCache(self.bus, core, cache_model)
+
+        self.cus = [ControlUnit(dp, predecoded=True, microcode=self.microcode) for dp in self.dps]
+
+        mc_mem, start_ids = self.microcode
+        self.locked_lines = set()
+        for code, start in start_ids.items():
+            if code_to_operation(code)[0] == Opcode.XCHG:
+                self.locked_lines.update(block_lines(mc_mem, start))
+        self.memory_lines = {i for i, line in enumerate(mc_mem) if line[bit_dict["DIN"]] or line[bit_dict["DOUT"]]}
+
+        self.stats = [dict.fromkeys(CORE_STATS, 0) for _ in range(cores)]
+        self.halt_reasons = [None] * cores
+        self.tick = 0
+
+    def juggernaut(self, tick_limit=TICK_LIMIT):
+        """
+        Run until every core stops; returns the tick of the last one, -1 if `tick_limit` is exceeded
+        """
+        cores = len(self.cus)
+        while any(reason is None for reason in self.halt_reasons):
+            self.tick += 1
+            for i in range(cores):
+                core = (self.tick + i) % cores
+                if self.halt_reasons[core] is None and self.stats[core]["ticks"] < self.tick:
+                    self._step(core)
+
+            if self.tick > tick_limit:
+                for core in range(cores):
+                    if self.halt_reasons[core] is None:
+                        self.halt_reasons[core] = "tick_limit"
+                return -1
+        return max(i["ticks"] for i in self.stats)
+
+    def _step(self, core):
+        cu, dp, stats = self.cus[core], self.dps[core], self.stats[core]
+        if not self._acquire(core, cu.reg_ip):
+            stats["ticks"] = self.tick
+            stats["wait_ticks"] += 1
+            return
+
+        try:
+            cu.execute_predecoded()
+        except HltError:
+            self.halt_reasons[core] = "hlt"
+        except EmptyBufferError:
+            self.halt_reasons[core] = "empty_buffer"
+        else:
+            stats["ticks"] = self.tick + dp.stall
+            stats["stall_ticks"] += dp.stall
+            dp.stall = 0
+        stats["commands"] = cu.cmd_count
+
+        if self.bus.owner == core and (self.halt_reasons[core] is not None or cu.reg_ip not in self.locked_lines):
+            self.bus.owner = None
+
+    def _acquire(self, core, mc_ip):
+        """
+        False if the microinstruction at `mc_ip` has to wait for the bus held by another core
+        """
+        if self.bus.owner is None and mc_ip in self.locked_lines:
+            self.bus.owner = core
+            self.bus.stats["lock_transfers"] += 1
+        if self.bus.owner in [None, core]:
+            return True
+        return mc_ip not in self.locked_lines and mc_ip not in self.memory_lines
+
+    def report(self):
+        lines = list()
+        for core, (dp, stats) in enumerate(zip(self.dps, self.stats)):
+            output = dp.output_buffer + dp.ports[0]["out"] + dp.ports[1]["out"]
+            text = "".join(str(render_value(i)) for i in output)
+            counters = ", ".join(f"{name}: {stats[name]}" for name in CORE_STATS)
+            cpi = stats["ticks"] / stats["commands"] if stats["commands"] else 0
+            lines.append(f"Core {core}: {text!r}, {counters}, CPI: {cpi:.3f}, halt: {self.halt_reasons[core]}")
+        lines.append("Bus: " + ", ".join(f"{name}: {self.bus.stats[name]}" for name in BUS_STATS))
+        lines.extend(f"Core {core} {cache.report()}" for core, cache in enumerate(self.bus.caches))
+        return "\n".join(lines)
+
+
+def main(program_name, input_name, cores=2, tick_limit=TICK_LIMIT, memory=None, cache=None):
+    machine = MultiCore(program_name, input_name, cores, memory, cache)
+    tick_count = machine.juggernaut(tick_limit)
+
+    print(machine.report())
+    print(f"\nTick count: {tick_count}, Command count: {sum(i['commands'] for i in machine.stats)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Several cores running one program on a shared data memory")
+    parser.add_argument("source_file")
+    parser.add_argument("input_file")
+    parser.add_argument("--cores", type=int, default=2)
+    parser.add_argument("--tick-limit", type=int, default=TICK_LIMIT, help="stop after this many ticks")
+    add_memory_arguments(parser)
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+    main(args.source_file, args.input_file, args.cores, args.tick_limit, memory_config(args), cache_config(args))
@@ -0,0 +1,229 @@
+"""
+Peephole optimizer of translated code.
+
+Works on the code of Translator.first_stage, while instruction arguments are
+still label names, and only inside straight-line code: an instruction with a
+code label may be entered by a jump, so it can be replaced but never removed,
+and nothing is merged across it.
+
+Removing an instruction which only recomputes the Z flag is valid when Z
+already matches acc. That holds after any ALU operation, but not on start,
+where acc is 0 and Z is not set, so such removals require an ALU operation
+right before the optimized sequence.
+
+In a program which enables interrupts (see interrupts.py) `hlt` is resumed
+by an interrupt, so the code after it is reachable, and the reset and
+interrupt vectors at the start of the code are neither removed nor moved.
+"""
+
+from interrupts import INTERRUPT_VECTORS
+from isa import Address, Opcode
+
+ALU_OPCODES = [
+    Opcode.INC,
+    Opcode.DEC,
+    Opcode.CLS,
+    Opcode.NEG,
+    Opcode.ADD,
+    Opcode.SUB,
+    Opcode.LOAD,
+    Opcode.INPUT,
+    Opcode.PORT1_IN,
+    Opcode.PORT2_IN,
+    Opcode.XCHG,
+]
+
+JUMP_OPCODES = [Opcode.JMP, Opcode.JMPZ]
+
+# Opcodes which never fall through to the next instruction
+STOP_OPCODES = [Opcode.JMP, Opcode.HLT, Opcode.IRET]
+
+INTERRUPT_OPCODES = [Opcode.EI, Opcode.IRET]
+
+# The reset vector and the interrupt vectors
+VECTOR_TABLE_SIZE = max(INTERRUPT_VECTORS.values()) + 1
+
+MAX_PASSES = 16
+
+
+def _literal_delta(instr):
+    """
+    Change of acc made by an instruction with a literal operand, or None
+    """
+    opcode, addr = instr["opcode"], instr["address_type"]
+    if opcode == Opcode.INC:
+        return 1
+    if opcode == Opcode.DEC:
+        return -1
+    if addr == Address.DIRECT and opcode == Opcode.ADD:
+        return instr["arg"]
+    if addr == Address.DIRECT and opcode == Opcode.SUB:
+        return -instr["arg"]
+    return None
+
+
+def _is_literal(instr):
+    return _literal_delta(instr) is not None
+
+
+def _merged(first, opcode, address_type, arg, replaced):
+    """
+    Instruction replacing `replaced`, keeping the source terms of all of them
+    """
+    text = "; ".join(i["term"][1] for i in replaced)
+    return {"opcode": opcode, "arg": arg, "address_type": address_type, "term": [first["term"][0], text]}
+
+
+class Optimizer:
+    def __init__(self, code, code_labels):
+        self.code = code
+        self.code_labels = code_labels
+        self.labeled = set(code_labels.values())
+        self.report = list()
+
+        self.stop_opcodes = STOP_OPCODES
+        self.fixed = 0
+        if any(instr["opcode"] in INTERRUPT_OPCODES for instr in code):
+            self.stop_opcodes = [i for i in STOP_OPCODES if i != Opcode.HLT]
+            self.fixed = VECTOR_TABLE_SIZE
+
+    def optimize(self):
+        """
+        Apply all rules until nothing changes; returns the new code and code labels
+        """
+        for _ in range(MAX_PASSES):
+            changes = len(self.report)
+            self._thread_jumps()
+            self._rewrite(self._fold_literals)
+            self._rewrite(self._drop_load_after_store)
+            self._rewrite(self._drop_unreachable)
+            if len(self.report) == changes:
+                break
+        return self.code, self.code_labels
+
+    def _log(self, instr, message):
+        self.report.append(f"{instr['term'][0]}: {message}")
+
+    def _alu_before(self, i):
+        return i > 0 and i not in self.labeled and self.code[i - 1]["opcode"] in ALU_OPCODES
+
+    def _rewrite(self, rule):
+        """
+        Replace code[i:i + n] with the instructions returned by `rule(i)` as (n, new_instructions),
+        then move the code labels to the new addresses. The vector table is kept as it is.
+        """
+        new_code = list()
+        new_addr = dict()
+        i = 0
+        while i < len(self.code):
+            new_addr[i] = len(new_code)
+            res = rule(i) if i >= self.fixed else None
+            if res is None:
+                new_code.append(self.code[i])
+                i += 1
+                continue
+            size, instructions = res
+            new_code.extend(instructions)
+            i += size
+
+        self.code = new_code
+        self.code_labels = {label: new_addr[addr] for label, addr in self.code_labels.items()}
+        self.labeled = set(self.code_labels.values())
+
+    def _run_end(self, i, accept):
+        """
+        End of the run of instructions from `i` matching `accept`, without labels after the first one
+        """
+        end = i + 1
+        while end < len(self.code) and end not in self.labeled and accept(self.code[end]):
+            end += 1
+        return end
+
+    def _fold_literals(self, i):
+        """
+        `cls` followed by literal arithmetic becomes `load 0xN`; a chain of `inc`, `dec`,
+        `add 0xN` and `sub 0xN` becomes one `add`/`sub`, or nothing if it does not change acc
+        """
+        instr = self.code[i]
+        if instr["opcode"] == Opcode.CLS and instr["address_type"] == Address.NO_OP:
+            end = self._run_end(i, _is_literal)
+            if end == i + 1:
+                return self._fold_cls_add(i)
+            value = sum(_literal_delta(x) for x in self.code[i + 1 : end])
+            self._log(instr, f"constant {value} is loaded with one instruction instead of {end - i}")
+            return end - i, [_merged(instr, Opcode.LOAD, Address.DIRECT, value, self.code[i:end])]
+
+        if not _is_literal(instr):
+            return None
+        end = self._run_end(i, _is_literal)
+        if end == i + 1:
+            return None
+        value = sum(_literal_delta(x) for x in self.code[i:end])
+        if value == 0 and self._alu_before(i):
+            self._log(instr, f"removed {end - i} instructions which do not change acc")
+            return end - i, []
+        opcode = Opcode.ADD if value >= 0 else Opcode.SUB
+        self._log(instr, f"{end - i} literal additions are folded into `{opcode.value} {abs(value)}`")
+        return end - i, [_merged(instr, opcode, Address.DIRECT, abs(value), self.code[i:end])]
+
+    def _fold_cls_add(self, i):
+        """
+        `cls` + `add X` is `load X`
+        """
+        if i + 1 >= len(self.code) or i + 1 in self.labeled:
+            return None
+        instr, next_instr = self.code[i], self.code[i + 1]
+        if next_instr["opcode"] != Opcode.ADD or next_instr["address_type"] != Address.LABEL_VAL:
+            return None
+        self._log(instr, f"`cls` + `add {next_instr['arg']}` is replaced with `load`")
+        return 2, [_merged(instr, Opcode.LOAD, Address.LABEL_VAL, next_instr["arg"], self.code[i : i + 2])]
+
+    def _drop_load_after_store(self, i):
+        """
+        `load X` right after `store X` reads back the value which is already in acc
+        """
+        instr = self.code[i]
+        if instr["opcode"] != Opcode.STORE or instr["address_type"] != Address.LABEL_VAL:
+            return None
+        if i + 1 >= len(self.code) or i + 1 in self.labeled or not self._alu_before(i):
+            return None
+        next_instr = self.code[i + 1]
+        if next_instr["opcode"] != Opcode.LOAD or next_instr["address_type"] != Address.LABEL_VAL:
+            return None
+        if next_instr["arg"] != instr["arg"]:
+            return None
+        self._log(next_instr, f"removed `load {instr['arg']}` after `store {instr['arg']}`")
+        return 2, [instr]
+
+    def _drop_unreachable(self, i):
+        """
+        Code after `jmp`, `iret` or `hlt` (without interrupts) is unreachable up to the next code label
+        """
+        instr = self.code[i]
+        if instr["opcode"] not in self.stop_opcodes:
+            return None
+        end = i + 1
+        while end < len(self.code) and end not in self.labeled:
+            end += 1
+        if end == i + 1:
+            return None
+        self._log(self.code[i + 1], f"removed {end - i - 1} unreachable instructions")
+        return end - i, [instr]
+
+    def _thread_jumps(self):
+        """
+        A jump to `jmp L` goes to L directly, as does a `jmpz` to `jmpz L`:
+        the flag is not changed between the two
+        """
+        for instr in self.code:
+            if instr["opcode"] not in JUMP_OPCODES:
+                continue
+            seen = {instr["arg"]}
+            target = self.code[self.code_labels[instr["arg"]]] if instr["arg"] in self.code_labels else None
+            while target is not None and target["opcode"] in [Opcode.JMP, instr["opcode"]]:
+                if target["arg"] in seen or target["arg"] not in self.code_labels:
+                    break
+                self._log(instr, f"jump to `{instr['arg']}` goes straight to `{target['arg']}`")
+                instr["arg"] = target["arg"]
+                seen.add(target["arg"])
+                target = self.code[self.code_labels[target["arg"]]]
@@ -0,0 +1,151 @@
+"""
+Profiler of translated programs.
+
+Profiler is a ControlUnit observer: after every tick it attributes the ticks
+passed since the previous one to the instruction at `IP` (from the fetch of
+an instruction up to the fetch of the next one) and counts an instruction as
+executed when its fetch is complete; an instruction whose fetch was stopped
+(`hlt`, the tick limit) is counted at `stop`, so the total equals the command
+count of ControlUnit. The report groups the counters by source line, code
+label, loop body (code between a backward jump and its target) and by
+operation and addressing type.
+"""
+
+import json
+
+from isa import Opcode, code_to_operation
+from machine_code import is_binary, read_binary
+from mc_consts import bit_dict
+
+
+def fetch_mc_ip(mc_mem):
+    """
+    Microcode address of the last line of the fetch block, which latches IR
+    """
+    return next(i for i, line in enumerate(mc_mem) if line[bit_dict["IR"]])
+
+
+def program_terms(program_name):
+    """
+    Source terms `[line number, text]` of every instruction, JSON or binary program
+    """
+    if is_binary(program_name):
+        debug = read_binary(program_name, with_debug=True)[3]
+        return None if debug is None else debug["code"]
+    with open(program_name) as f:
+        return [i["term"] for i in json.load(f)["code"]]
+
+
+def code_labels(terms):
+    """
+    Code labels by address, taken from the source text of the instructions
+    """
+    labels = dict()
+    for addr, (_, text) in enumerate(terms):
+        if ":" in text:
+            labels[addr] = text.split(":")[0].strip()
+    return labels
+
+
+def _percent(ticks, total):
+    return f"{100 * ticks / max(total, 1):>5.1f}%"
+
+
+class Profiler:
+    def __init__(self, mc_mem, instruct_mem_size):
+        self.fetch_mc_ip = fetch_mc_ip(mc_mem)
+        self.ticks = [0] * instruct_mem_size
+        self.counts = [0] * instruct_mem_size
+        self.last_tick = 0
+        self.dp = None
+
+    def record_reset(self, dp, tick=0):
+        self.dp = dp
+        self.last_tick = tick
+
+    def record(self, tick, mc_ip, dp):
+        ip = dp.reg_ip
+        self.ticks[ip] += tick - self.last_tick
+        self.last_tick = tick
+        if mc_ip == self.fetch_mc_ip:
+            self.counts[ip] += 1
+
+    def stop(self, halt_reason, mc_ip):
+        """
+        The fetch stopped before IR is latched (`hlt` or the tick limit) still counts
+        """
+        if mc_ip > self.fetch_mc_ip:
+            return
+        dp = self.dp
+        ip = dp.reg_ip if mc_ip > 0 else dp.signals_dict["MUX_ip"][dp.mux_ip_i]
+        self.counts[ip] += 1
+
+    def report(self, codes, args, terms=None, top=10):
+        """
+        Text report; `codes` and `args` are the instruction memory, `terms` the source terms if known
+        """
+        total = sum(self.ticks)
+        addrs = [i for i in range(len(self.ticks)) if self.ticks[i] or self.counts[i]]
+        labels = {} if terms is None else code_labels(terms)
+
+        lines = [f"Profile: {total} ticks, {sum(self.counts)} instructions"]
+        lines.append("Hot lines:")
+        lines.append(f"  {'addr':>5} {'count':>7} {'ticks':>8} {'%':>6}  source")
+        for addr in sorted(addrs, key=lambda i: -self.ticks[i])[:top]:
+            source = self._source(addr, codes, terms)
+            lines.append(
+                f"  {addr:>5} {self.counts[addr]:>7} {self.ticks[addr]:>8} {_percent(self.ticks[addr], total)}  {source}"
+            )
+
+        range_header = f"  {'label':<12} {'addrs':^12} {'count':>7} {'ticks':>8} {'%':>6}"
+        lines.extend(["Labels:", range_header])
+        lines.extend(self._range_lines(self._label_ranges(labels, len(terms or codes)), total))
+        lines.extend(["Loops:", range_header])
+        lines.extend(self._range_lines(self._loop_ranges(codes, args, labels), total))
+
+        lines.extend(["Operations:", f"  {'operation':<22} {'count':>7} {'ticks':>8} {'%':>6}"])
+        by_operation = dict()
+        for addr in addrs:
+            counters = by_operation.setdefault(code_to_operation(codes[addr]), [0, 0])
+            counters[0] += self.counts[addr]
+            counters[1] += self.ticks[addr]
+        for (opcode, addr_type), (count, ticks) in sorted(by_operation.items(), key=lambda i: -i[1][1]):
+            name = f"{opcode.name} {addr_type.name}"
+            lines.append(f"  {name:<22} {count:>7} {ticks:>8} {_percent(ticks, total)}")
+
+        return "".join(i + "\n" for i in lines)
+
+    @staticmethod
+    def _source(addr, codes, terms):
+        if terms is not None:
+            return f"{terms[addr][0]}: {terms[addr][1]}"
+        opcode, addr_type = code_to_operation(codes[addr])
+        return f"{opcode.value} {addr_type.name}"
+
+    @staticmethod
+    def _label_ranges(labels, size):
+        starts = sorted(labels)
+        ends = starts[1:] + [size]
+        return [(labels[start], start, end - 1) for start, end in zip(starts, ends)]
+
+    @staticmethod
+    def _loop_ranges(codes, args, labels):
+        """
+        Loop bodies: from the target of every backward jump up to the jump
+        """
+        loops = list()
+        for addr, code in enumerate(codes):
+            if code_to_operation(code)[0] in [Opcode.JMP, Opcode.JMPZ] and args[addr] <= addr:
+                target = args[addr]
+                loops.append((labels.get(target, f"@{target}"), target, addr))
+        return loops
+
+    def _range_lines(self, ranges, total):
+        res = list()
+        for name, first, last in sorted(ranges, key=lambda i: -sum(self.ticks[i[1] : i[2] + 1])):
+            ticks = sum(self.ticks[first : last + 1])
+            if ticks == 0:
+                continue
+            count = sum(self.counts[first : last + 1])
+            res.append(f"  {name:<12} {first:>5}..{last:<5} {count:>7} {ticks:>8} {_percent(ticks, total)}")
+        return res
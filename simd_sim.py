@@ -0,0 +1,267 @@
+"""
+Lockstep simulation of one program on many inputs.
+
+SimdMachine runs N independent copies of the microcoded machine at once: every
+register, signal and the data memory are NumPy arrays with one lane per
+machine. On each tick the running lanes are grouped by the address of their
+current microinstruction and every signal of that microinstruction is applied
+to the whole group with vectorized operations, in the order ControlUnit
+handles them. Lanes stop independently; results, ticks and command counts are
+the ones ControlUnit reports for each input.
+
+Words are int64 and data memory cells are stored the way the binary program
+format stores them.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+from control_unit import TICK_LIMIT
+from data_path import DATA_MEM_SIZE, HLT_CODE, INSTRUCT_MEM_SIZE, DataPath, MemoryAccessError, render_value
+from isa import Opcode, code_table
+from machine_code import _to_word
+from mc_consts import INT_CTL_VALUES, bit_dict
+from mc_generator import generate_mc
+from streams import INPUT_WORDS, decode_input
+
+HALT_REASONS = [None, "hlt", "empty_buffer", "tick_limit"]
+
+IP, IM, MUX_IP, MUX_JMP_TYPE, IR, MUX_ADDR, ADDR, MUX_ALU, MUX_ALU_INPUT, ALU, ACC = range(11)
+OUTPUT, DIN, DOUT, M_MUX_IP, M_IP, PORT1_OUT, PORT2_OUT, INT_CTL = (
+    bit_dict[i] for i in ["OUTPUT", "DIN", "DOUT", "M_MUX_IP", "M_IP", "PORT1_OUT", "PORT2_OUT", "INT_CTL"]
+)
+
+ALU_FUNCS = {
+    Opcode.INC: lambda acc, mux: acc + 1,
+    Opcode.DEC: lambda acc, mux: acc - 1,
+    Opcode.CLS: lambda acc, mux: np.zeros_like(acc),
+    Opcode.NEG: lambda acc, mux: -acc,
+    Opcode.ADD: lambda acc, mux: acc + mux,
+    Opcode.SUB: lambda acc, mux: acc - mux,
+    Opcode.LOAD: lambda acc, mux: mux,
+    Opcode.INPUT: lambda acc, mux: mux,
+    Opcode.PORT1_IN: lambda acc, mux: mux,
+    Opcode.PORT2_IN: lambda acc, mux: mux,
+    Opcode.XCHG: lambda acc, mux: mux,
+}
+
+
+class SimdMachine:
+    def __init__(
+        self,
+        program_name,
+        input_texts,
+        data_mem_size=DATA_MEM_SIZE,
+        instruct_mem_size=INSTRUCT_MEM_SIZE,
+        microcode=None,
+    ):
+        dp = DataPath(data_mem_size, instruct_mem_size, None)
+        dp.load_program(program_name)
+        self.instr_codes = np.array(dp.instr_codes, dtype=np.int64)
+        self.instr_args = np.array(dp.instr_args, dtype=np.int64)
+
+        self.mc_mem, start_ids = generate_mc() if microcode is None else microcode
+        self.decode_table = np.zeros(max(code_table) + 1, dtype=np.int64)
+        for code, start in start_ids.items():
+            self.decode_table[code] = start
+
+        n = len(input_texts)
+        self.size = n
+        self.mem = np.tile(np.array([_to_word(i) for i in dp.data_mem], dtype=np.int64), (n, 1))
+        self._load_inputs(input_texts)
+
+        regs = ["line", "mc_ip", "mux_ip_i", "reg_ip", "sig_reg_ip", "reg_ir", "sig_reg_ir", "alu_instr"]
+        regs += ["reg_addr", "sig_reg_addr", "acc", "sig_acc", "data_mem_input", "jmp_type_1"]
+        regs += ["mux_ip_0", "mux_ip_1", "mux_addr_0", "mux_addr_1", "mux_alu_0", "mux_alu_1"]
+        regs += ["cmd_count", "tick_count", "halt_code", "interrupt_enable", "saved_ip"]
+        for name in regs:
+            setattr(self, name, np.zeros(n, dtype=np.int64))
+        self.flag_z = np.zeros(n, dtype=bool)
+        self.sig_z = np.zeros(n, dtype=bool)
+        self.halted = np.zeros(n, dtype=bool)
+
+        self.outputs = [[list() for _ in range(n)] for _ in range(3)]
+
+        # ControlUnit construction: set_mux(0), latch_ip, get_mc_instruction_signal
+        self.cmd_count[:] = 1
+
+    def _load_inputs(self, input_texts):
+        buffers = [decode_input(text) for text in input_texts]
+        width = max([len(b) for lane in buffers for b in lane] + [1])
+        self.in_buf = np.zeros((INPUT_WORDS, self.size, width), dtype=np.int64)
+        self.in_len = np.zeros((INPUT_WORDS, self.size), dtype=np.int64)
+        self.in_pos = np.zeros((INPUT_WORDS, self.size), dtype=np.int64)
+        for lane, lane_buffers in enumerate(buffers):
+            for k, buffer in enumerate(lane_buffers):
+                self.in_buf[k, lane, : len(buffer)] = list(buffer)
+                self.in_len[k, lane] = len(buffer)
+
+    def juggernaut(self, tick_limit=TICK_LIMIT):
+        tick = 0
+        while not self.halted.all():
+            tick += 1
+            active = np.flatnonzero(~self.halted)
+            lines = self.line[active]
+            for addr in np.unique(lines):
+                lanes = self._execute(self.mc_mem[addr], active[lines == addr])
+                self.tick_count[lanes] = tick
+
+            if tick > tick_limit:
+                running = ~self.halted
+                self.halt_code[running] = HALT_REASONS.index("tick_limit")
+                self.tick_count[running] = -1
+                self.halted[running] = True
+
+    def _halt(self, lanes, stop, reason):
+        self.halted[lanes[stop]] = True
+        self.halt_code[lanes[stop]] = HALT_REASONS.index(reason)
+        return lanes[~stop]
+
+    def _check_addr(self, lanes):
+        # NumPy would wrap a negative computed address around and fail on a large one without the lane
+        addrs = self.sig_reg_addr[lanes]
+        bad = (addrs < 0) | (addrs >= self.mem.shape[1])
+        if bad.any():
+            lane = lanes[bad][0]
+            raise MemoryAccessError(int(self.reg_ip[lane]), int(self.sig_reg_addr[lane]))
+
+    def _execute(self, line, lanes):  # noqa: C901
+        """
+        Apply one microinstruction to `lanes`; returns the lanes which did not stop on it
+        """
+        if line[IP]:
+            self.reg_ip[lanes] = np.where(self.mux_ip_i[lanes] == 0, self.mux_ip_0[lanes], self.mux_ip_1[lanes])
+            self.mux_ip_1[lanes] = self.reg_ip[lanes] + 1
+            self.sig_reg_ip[lanes] = self.reg_ip[lanes]
+        if line[IM]:
+            ip = self.sig_reg_ip[lanes]
+            self.sig_reg_ir[lanes] = self.alu_instr[lanes] = self.instr_codes[ip]
+            self.mux_addr_1[lanes] = self.mux_ip_0[lanes] = self.mux_alu_0[lanes] = self.instr_args[ip]
+        # MUX_IP and MUX_JMP_TYPE: MUX_jmp_type[0] is the MUX_IP bit, MUX_jmp_type[1] is 1 - Z
+        self.mux_ip_i[lanes] = line[MUX_IP] if line[MUX_JMP_TYPE] == 0 else self.jmp_type_1[lanes]
+        if line[IR]:
+            self.reg_ir[lanes] = self.sig_reg_ir[lanes]
+            lanes = self._halt(lanes, self.reg_ir[lanes] == HLT_CODE, "hlt")
+        if line[ADDR]:
+            source = self.mux_addr_0 if line[MUX_ADDR] == 0 else self.mux_addr_1
+            self.reg_addr[lanes] = self.sig_reg_addr[lanes] = source[lanes]
+        if line[ALU]:
+            lanes = self._alu(lanes, line[MUX_ALU], line[MUX_ALU_INPUT])
+        if line[ACC]:
+            acc = self.sig_acc[lanes]
+            self.flag_z[lanes] = self.sig_z[lanes]
+            self.jmp_type_1[lanes] = 1 - self.flag_z[lanes]
+            self.acc[lanes] = self.mux_alu_1[lanes] = self.data_mem_input[lanes] = acc
+        if line[OUTPUT]:
+            self._output(0, lanes)
+        if line[DIN]:
+            self._check_addr(lanes)
+            self.mem[lanes, self.sig_reg_addr[lanes]] = self.data_mem_input[lanes]
+        if line[DOUT]:
+            self._check_addr(lanes)
+            self.mux_addr_0[lanes] = self.mux_alu_1[lanes] = self.mem[lanes, self.sig_reg_addr[lanes]]
+        if line[M_IP]:
+            self._latch_mc_ip(line[M_MUX_IP], lanes)
+        self.line[lanes] = self.mc_ip[lanes]
+        if line[PORT1_OUT]:
+            self._output(1, lanes)
+        if line[PORT2_OUT]:
+            self._output(2, lanes)
+        if line[INT_CTL]:
+            self._interrupt_control(line[INT_CTL], lanes)
+        return lanes
+
+    def _alu(self, lanes, mux_alu, mux_input):
+        if mux_input == 0:
+            mux = (self.mux_alu_0 if mux_alu == 0 else self.mux_alu_1)[lanes]
+        else:
+            k = mux_input - 1
+            lanes = self._halt(lanes, self.in_pos[k, lanes] >= self.in_len[k, lanes], "empty_buffer")
+            mux = self.in_buf[k, lanes, self.in_pos[k, lanes]]
+            self.in_pos[k, lanes] += 1
+
+        acc = self.acc[lanes]
+        codes = self.alu_instr[lanes]
+        res = np.empty_like(acc)
+        for code in np.unique(codes):
+            same = codes == code
+            res[same] = ALU_FUNCS[code_table[int(code)][0]](acc[same], mux[same])
+        self.sig_acc[lanes] = res
+        self.sig_z[lanes] = res == 0
+        return lanes
+
+    def _interrupt_control(self, value, lanes):
+        """
+        `ei`, `di` and `iret`; there is no timed port input, so interrupts are never requested
+        """
+        if value == INT_CTL_VALUES["IRET"]:
+            self.mux_ip_0[lanes] = self.saved_ip[lanes]
+        self.interrupt_enable[lanes] = value != INT_CTL_VALUES["DI"]
+
+    def _latch_mc_ip(self, mux, lanes):
+        if mux == 0:
+            self.mc_ip[lanes] = 0
+            self.cmd_count[lanes] += 1
+        elif mux == 1:
+            self.mc_ip[lanes] += 1
+        else:
+            self.mc_ip[lanes] = self.decode_table[self.reg_ir[lanes]]
+
+    def _output(self, k, lanes):
+        outputs = self.outputs[k]
+        for lane, value in zip(lanes.tolist(), self.acc[lanes].tolist()):
+            outputs[lane].append(value)
+
+    def results(self):
+        return [
+            {
+                "output": self.outputs[0][lane],
+                "ports": [self.outputs[1][lane], self.outputs[2][lane]],
+                "tick_count": int(self.tick_count[lane]),
+                "cmd_count": int(self.cmd_count[lane]),
+                "halt_reason": HALT_REASONS[self.halt_code[lane]],
+            }
+            for lane in range(self.size)
+        ]
+
+
+def run_inputs(program_name, input_names, tick_limit=TICK_LIMIT, microcode=None):
+    input_texts = list()
+    for name in input_names:
+        with open(name) as f:
+            input_texts.append(f.read())
+
+    machine = SimdMachine(program_name, input_texts, microcode=microcode)
+    machine.juggernaut(tick_limit)
+    return machine.results()
+
+
+def main(program_name, input_names, results_name=None, tick_limit=TICK_LIMIT):
+    start = time.perf_counter()
+    results = run_inputs(program_name, input_names, tick_limit)
+    wall_time = time.perf_counter() - start
+
+    for name, result in zip(input_names, results):
+        result["input"] = name
+    if results_name is not None:
+        with open(results_name, "w") as f:
+            json.dump({"program": program_name, "wall_time": wall_time, "results": results}, f, indent=2)
+    else:
+        for result in results:
+            output = result["output"] + result["ports"][0] + result["ports"][1]
+            text = "".join(str(render_value(i)) for i in output)
+            print(f"{result['input']}: {text!r}, ticks: {result['tick_count']}, commands: {result['cmd_count']}")
+
+    print(f"Inputs: {len(results)}, wall time: {wall_time:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run one program on many inputs in lockstep")
+    parser.add_argument("program_file")
+    parser.add_argument("input_files", nargs="+")
+    parser.add_argument("--results", metavar="FILE", help="write results as JSON instead of printing them")
+    parser.add_argument("--tick-limit", type=int, default=TICK_LIMIT)
+    args = parser.parse_args()
+    main(args.program_file, args.input_files, args.results, args.tick_limit)
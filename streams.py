@@ -0,0 +1,113 @@
+"""
+Streaming I/O buffers of DataPath.
+
+By default the input buffers are deques filled from the input file before the
+run. InputStream reads the input lazily from a file or a pipe, and OutputStream
+writes every output value to a file as soon as the machine produces it, so a
+program can process an input of any size in constant memory.
+
+Both keep the interface the machine uses: `popleft` (IndexError when there is no
+more input) and `append`.
+
+Every input path decodes the input the same way (see decode_input): the input
+buffer, port 1 and port 2 get the first three whitespace separated words of the
+input, every character by char_value.
+"""
+
+import re
+from collections import deque
+
+CHUNK_SIZE = 1 << 16
+
+WORD_RE = re.compile(r"\S*")
+
+# Input buffer, port 1 and port 2
+INPUT_WORDS = 3
+
+
+def char_value(ch):
+    """
+    Digits are input by value, other characters by their code
+    """
+    return int(ch) if ch.isdigit() else ord(ch)
+
+
+class InputFormatError(Exception):
+    def __init__(self, words):
+        super().__init__(
+            f"Input has {words} words, expected at most {INPUT_WORDS}: the input buffer, port 1 and port 2"
+        )
+
+
+def decode_word(word):
+    return [char_value(ch) for ch in word]
+
+
+def decode_input(text):
+    """
+    Values of the input buffer and the ports from an input text
+    """
+    words = text.split()
+    if len(words) > INPUT_WORDS:
+        raise InputFormatError(len(words))
+    return [deque(decode_word(word)) for word in words] + [deque() for _ in range(INPUT_WORDS - len(words))]
+
+
+class InputStream:
+    """
+    Input buffer over a text file: the first word of the file, decoded as decode_input does,
+    is read as the machine consumes it. The rest of the file is not read, ports get no input.
+    """
+
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.chunk = deque()
+        self.started = False
+        self.ended = False
+
+    def popleft(self):
+        while not self.chunk and not self.ended:
+            self._read_chunk()
+        return self.chunk.popleft()
+
+    def _read_chunk(self):
+        text = self.file.read(self.chunk_size)
+        if not text:
+            self.ended = True
+            return
+        if not self.started:
+            # whitespace before the word
+            text = text.lstrip()
+            self.started = bool(text)
+        word = WORD_RE.match(text).group()
+        # whitespace after the word ends the input
+        self.ended = len(word) < len(text)
+        self.chunk.extend(decode_word(word))
+
+
+class OutputStream:
+    """
+    Output sink writing rendered values to a text file; the values are not kept
+    """
+
+    def __init__(self, file, render):
+        self.file = file
+        self.render = render
+        self.count = 0
+
+    def append(self, value):
+        self.file.write(str(self.render(value)))
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(())
+
+    def __repr__(self):
+        return f"<{self.count} values written to {getattr(self.file, 'name', self.file)}>"
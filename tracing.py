@@ -0,0 +1,40 @@
+"""
+Debug journal of the simulation.
+
+Messages of the hot loop are built only when the DEBUG level is enabled;
+the journal can be redirected to a file through an in-memory buffer,
+so it is written in large blocks instead of line by line.
+"""
+
+import logging
+from logging.handlers import MemoryHandler
+
+LOG_FORMAT = "%(levelname)-7s %(module)s:%(funcName)-13s %(message)s"
+
+TRACE_CAPACITY = 4096
+
+
+def debug_enabled():
+    return logging.root.isEnabledFor(logging.DEBUG)
+
+
+def start_trace(filename, level=logging.DEBUG, capacity=TRACE_CAPACITY):
+    """
+    Send the journal to `filename`, flushing every `capacity` records
+    """
+    file_handler = logging.FileHandler(filename, mode="w", encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    handler = MemoryHandler(capacity, flushLevel=logging.CRITICAL, target=file_handler)
+    handler.previous_level = logging.root.level
+    logging.root.addHandler(handler)
+    logging.root.setLevel(level)
+    return handler
+
+
+def stop_trace(handler):
+    target = handler.target
+    logging.root.removeHandler(handler)
+    logging.root.setLevel(handler.previous_level)
+    handler.close()
+    target.close()
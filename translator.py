@@ -1,7 +1,13 @@
+import argparse
+import functools
+import hashlib
 import json
-import sys
+import re
+from array import array
 
-from isa import Address, Opcode, allowed_addressing
+from isa import Address, Opcode, allowed_addressing, operation_to_code
+from machine_code import data_to_mem, write_binary
+from optimizer import Optimizer
 
 
 def _print_string(str_list):
@@ -10,8 +16,96 @@ def _print_string(str_list):
 
 
 class InvalidCodeError(Exception):
-    def __init__(self, too_many_symbol, data_line):
-        super().__init__(f'Invalid code: too many "{too_many_symbol}" in  "{data_line}"')
+    def __init__(self, line, column, text, reason):
+        super().__init__(f'Invalid code at line {line}, column {column}: {reason} in "{text}"')
+
+
+class _LineError(Exception):
+    """
+    Syntax error at `column` of a clean line, before the line is known
+    """
+
+    def __init__(self, column, reason):
+        super().__init__(reason)
+        self.column = column
+        self.reason = reason
+
+
+# Quotes and the `inp 0xN`/`outp 0xN` port forms are rewritten in one pass
+NORMALIZE_RE = re.compile(r"'|(inp|outp) 0x([12])")
+
+DATA_RE = re.compile(
+    r"""
+    (?:(?P<label>\w+):\s*)?
+    (?:"(?P<text>[^"]*)"|\((?P<reserve>\d+)\)|0x(?P<number>\d+)|(?P<raw>\w+))?
+    """,
+    re.VERBOSE,
+)
+
+INSTR_RE = re.compile(
+    r"""
+    (?:(?P<label>\w+):\s*)?
+    (?P<opcode>\w+)?
+    (?:\ (?:0x(?P<literal>\d+)|&(?P<label_addr>\w+)|\((?P<indirect>\w+)\)|(?P<label_val>\w+)))?
+    """,
+    re.VERBOSE,
+)
+
+OPCODES = {i.value: i for i in allowed_addressing}
+
+# Parsed lines are cached: generated sources repeat the same lines a lot
+PARSE_CACHE_SIZE = 1 << 14
+
+ARG_GROUPS = {
+    "literal": Address.DIRECT,
+    "label_addr": Address.LABEL_ADDR,
+    "indirect": Address.INDIRECT,
+    "label_val": Address.LABEL_VAL,
+}
+
+
+def _normalize(match):
+    if match.group(1) is None:
+        return '"'
+    return f"port{match.group(2)}_{'in' if match.group(1) == 'inp' else 'out'}"
+
+
+def clean_lines(lines):
+    """
+    Remove comments and empty lines and strip lines of an iterable of source lines (a text file works).
+    Yields (line number, column of the first symbol, clean text, stripped source text); the last two are
+    the same object unless the line was normalized
+    """
+    for line_no, line in enumerate(lines, 1):
+        line = line.partition("//")[0]
+        source = text = line.strip()
+        if text == "":
+            continue
+        if "'" in text or "p 0x" in text:
+            text = NORMALIZE_RE.sub(_normalize, text)
+        yield line_no, len(line) - len(line.lstrip()), text, source
+
+
+def source_offset(source, offset):
+    """
+    Offset in the stripped source text of `offset` in its normalized text; inside a rewritten
+    port form it is the start of the form
+    """
+    shift = 0
+    for match in NORMALIZE_RE.finditer(source):
+        start = match.start() + shift
+        if offset < start:
+            break
+        size = len(_normalize(match))
+        if offset < start + size:
+            return match.start()
+        shift += size - len(match.group())
+    return offset - shift
+
+
+def _check_end(match, line):
+    if match.end() != len(line):
+        raise _LineError(match.end(), f"unexpected {line[match.end() :]!r}")
 
 
 class Translator:
@@ -21,10 +115,19 @@ class Translator:
 
     data_labels = None
     code_labels = None
+    report = None
 
-    def __init__(self, filename):
-        with open(filename) as f:
-            self.text = f.readlines()
+    def __init__(self, source):
+        """
+        `source` is a file name or an open text file
+        """
+        self.source = source
+        self.text = list()
+        # source line number and column of the first symbol of every clean line
+        self.line_numbers = array("l")
+        self.columns = array("l")
+        # source text of the clean lines changed by the normalization, by clean line index
+        self.sources = dict()
 
         self.data = list()
         self.code = list()
@@ -37,23 +140,21 @@ class Translator:
         remove comments, empty lines and strip lines
 
         """
-
-        new_text = list()
-
-        for i in self.text:
-            i = i.split("//")[0]
-            i = i.strip()
-            i = i.replace("'", '"')
-            i = i.replace("inp 0x1", "port1_in")
-            i = i.replace("inp 0x2", "port2_in")
-            i = i.replace("outp 0x1", "port1_out")
-            i = i.replace("outp 0x2", "port2_out")
-            if i != "":
-                new_text.append(i)
-
-        self.text = new_text
-
-    def first_stage(self):  # noqa: C901
+        if hasattr(self.source, "read"):
+            self._read_lines(self.source)
+            return
+        with open(self.source) as f:
+            self._read_lines(f)
+
+    def _read_lines(self, lines):
+        for line_no, column, text, source in clean_lines(lines):
+            if source is not text:
+                self.sources[len(self.text)] = source
+            self.line_numbers.append(line_no)
+            self.columns.append(column)
+            self.text.append(text)
+
+    def first_stage(self):
         """
         first stage:
             clean up code text
@@ -62,117 +163,193 @@ class Translator:
         :return:
         """
 
-        data_place = 0
-        instruct_place = 0
-
         self._clean_code()
 
-        i = 0
-        while i < len(self.text):
-            data_line = self.text[i]
-
-            if data_line == "section .data":
-                i += 1
-                continue
-            if data_line == "section .code":
-                i += 1
-                break
+        data_place = 0
+        for section, start, entries in self.records():
+            if section == "data":
+                data_place = self._place_data(start, entries, data_place)
+            else:
+                self._place_code(start, entries)
 
-            if data_line.count(":") > 1:
-                raise InvalidCodeError(":", data_line)
+    def records(self):
+        """
+        Parsed regions of the clean text in program order: (section, index of the first line, entries),
+        an entry is (label or None, payload), payload is (initial values, number of memory cells)
+        for data and the instruction for code
+        """
+        for section, start, lines in self._regions():
+            yield section, start, self._parse_region(section, start, lines)
 
-            if data_line.count(":") == 1:
-                label, data_line = data_line.split(":")
-                data_line = data_line.strip()
+    def _place_data(self, start, entries, data_place):
+        data = self.data
+        for index, (label, (init, size)) in enumerate(entries, start):
+            if label is not None:
                 self.data_labels[label] = data_place
-
-            if data_line[-1] == '"':  # string
-                data_line = [ord(i) for i in data_line[1:-1]]
-
-            elif data_line[-1] == ")":  # reserve mem
-                symbols_num = int(data_line[1:-1])
-                data_line = [0] * symbols_num
-            elif data_line[:2] == "0x":
-                data_line = [int(data_line[2:])]
-                data_place -= 1
-
-            self.data.append({"size": len(data_line), "init": list(data_line), "scr_line": i})
-
-            data_place += len(data_line) + 1
-
-            i += 1
-
-        while i < len(self.text):
-            origin_line = instr_line = self.text[i]
-
-            if instr_line.count(":") > 1:
-                raise InvalidCodeError(":", data_line)
-
-            if instr_line.count(":") == 1:
-                label, instr_line = instr_line.split(":")
-                instr_line = instr_line.strip()
-                self.code_labels[label] = instruct_place
-            if instr_line.count(" ") > 1:
-                raise InvalidCodeError(" ", data_line)  # noqa: TRY003
-
-            op = 0
-            address_type = Address.NO_OP
-
-            if instr_line.count(" ") == 1:
-                instr_line, op = instr_line.split(" ")
-                if op[:2] == "0x":
-                    address_type = Address.DIRECT
-                    op = int(op[2:])
-                elif op[0] == "&":
-                    address_type = Address.LABEL_ADDR
-                    op = op[1:]
-                elif op[0] == "(":
-                    address_type = Address.INDIRECT
-                    op = op[1:-1]
-                else:
-                    address_type = Address.LABEL_VAL
-                    op = op
-
-            instr = Opcode(instr_line)
-
-            self.code.append({"opcode": instr, "arg": op, "address_type": address_type, "term": [i, origin_line]})
-
-            instruct_place += 1
-
-            i += 1
+            data.append({"size": len(init), "init": list(init), "scr_line": index})
+            data_place += size
+        return data_place
+
+    def _place_code(self, start, entries):
+        code, text = self.code, self.text
+        for index, (label, instr) in enumerate(entries, start):
+            if label is not None:
+                self.code_labels[label] = len(code)
+            code.append(dict(instr, term=[index, text[index]]))
+
+    def _regions(self):
+        """
+        Split the clean text into regions of one section, a label starts a new region.
+        Returns (section, index of the first line, lines)
+        """
+        section = "data"
+        bounds = list()
+        start = 0
+        for i, line in enumerate(self.text):
+            header = section == "data" and line in ["section .data", "section .code"]
+            if header or ":" in line:
+                bounds.append((section, start, i))
+                start = i + 1 if header else i
+            if header and line == "section .code":
+                section = "code"
+        bounds.append((section, start, len(self.text)))
+
+        return [(section, start, self.text[start:end]) for section, start, end in bounds if end > start]
+
+    def _parse_region(self, section, start, lines):
+        """
+        Parsed lines of a region, independent of its place in the program
+        """
+        parse = self._parse_data_line if section == "data" else self._parse_instr_line
+        try:
+            return [parse(i) for i in lines]
+        except _LineError as e:
+            i = next(i for i, line in enumerate(lines) if not self._parses(parse, line))
+            raise self._error(start + i, e.column, e.reason) from None
+
+    def _error(self, index, offset, reason):
+        """
+        InvalidCodeError at `offset` of the clean line `index`, located and quoted in the source
+        """
+        source = self.sources.get(index, self.text[index])
+        column = self.columns[index] + source_offset(source, offset) + 1
+        return InvalidCodeError(self.line_numbers[index], column, source, reason)
+
+    @staticmethod
+    def _parses(parse, line):
+        try:
+            parse(line)
+        except _LineError:
+            return False
+        return True
+
+    @staticmethod
+    @functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+    def _parse_data_line(line):
+        """
+        (label, (initial values, number of memory cells taken))
+        """
+        match = DATA_RE.match(line)
+        _check_end(match, line)
+        label, text, reserve, number, raw = match.group("label", "text", "reserve", "number", "raw")
+
+        if text is not None:
+            return label, ([ord(i) for i in text], len(text) + 1)
+        if reserve is not None:
+            return label, ([0] * int(reserve), int(reserve) + 1)
+        if number is not None:
+            return label, ([int(number)], 1)
+        if raw is None:
+            raise _LineError(match.end(), "expected data")
+        return label, (raw, len(raw) + 1)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+    def _parse_instr_line(line):
+        """
+        (label, instruction without the source term)
+        """
+        match = INSTR_RE.match(line)
+        _check_end(match, line)
+        opcode = OPCODES.get(match["opcode"])
+        if opcode is None:
+            column = match.start("opcode") if match["opcode"] is not None else match.end()
+            raise _LineError(
+                column, f"unknown instruction {match['opcode']!r}" if match["opcode"] else "expected an instruction"
+            )
+
+        arg, address_type = 0, ARG_GROUPS.get(match.lastgroup, Address.NO_OP)
+        if address_type == Address.DIRECT:
+            arg = int(match["literal"])
+        elif address_type != Address.NO_OP:
+            arg = match[match.lastgroup]
+
+        return match["label"], {"opcode": opcode, "arg": arg, "address_type": address_type}
 
     def second_stage(self):
         """
         Replace labels with memory addresses
         """
 
-        for i in range(len(self.code)):
-            instr = self.code[i]
-
-            addr_type = instr["address_type"]
-            arg = instr["arg"]
-            if addr_type not in allowed_addressing[instr["opcode"]]:
-                raise Exception(f"Invalid address type for instruction: {instr['opcode']}")  # noqa: TRY002, TRY003
-
-            if addr_type not in [Address.LABEL_ADDR, Address.LABEL_VAL, Address.INDIRECT]:
-                continue
+        for instr in self.code:
+            self._resolve(instr)
 
-            if instr["opcode"] in [Opcode.JMP, Opcode.JMPZ]:
-                if arg not in self.code_labels.keys():
-                    raise Exception(f"No code label: {arg}")  # noqa: TRY002, TRY003
-                instr["arg"] = self.code_labels[arg]
-                continue
+    def _resolve(self, instr):
+        """
+        Replace the label argument of `instr` with its address.
+        Returns ("code" or "data", label) for label arguments, otherwise None
+        """
+        addr_type = instr["address_type"]
+        arg = instr["arg"]
+        if addr_type not in allowed_addressing[instr["opcode"]]:
+            raise self._arg_error(instr, "invalid addressing for the instruction")
+
+        if addr_type not in [Address.LABEL_ADDR, Address.LABEL_VAL, Address.INDIRECT]:
+            return None
+
+        if instr["opcode"] in [Opcode.JMP, Opcode.JMPZ]:
+            if arg not in self.code_labels:
+                raise self._arg_error(instr, f"no code label {arg!r}")
+            instr["arg"] = self.code_labels[arg]
+            return "code", arg
+
+        if arg not in self.data_labels:
+            raise self._arg_error(instr, f"no data label {arg!r}")
+        instr["arg"] = self.data_labels[arg]
+        return "data", arg
+
+    def _arg_error(self, instr, reason):
+        """
+        InvalidCodeError at the argument of `instr`, or at its instruction if it has none
+        """
+        index = instr["term"][0]
+        match = INSTR_RE.match(self.text[index])
+        # the argument follows the space after the opcode
+        offset = match.end("opcode") + 1 if match.lastgroup in ARG_GROUPS else match.start("opcode")
+        return self._error(index, offset, reason)
 
-            if arg not in self.data_labels.keys():
-                raise Exception(f"No data label: {arg}")  # noqa: TRY002, TRY003
-            instr["arg"] = self.data_labels[arg]
+    def optimize(self):
+        """
+        Peephole optimization of the first stage code, see optimizer.py.
+        Returns the list of changes.
+        """
+        optimizer = Optimizer(self.code, self.code_labels)
+        self.code, self.code_labels = optimizer.optimize()
+        return optimizer.report
 
-    def translate(self, target, args=None):
+    def translate(self, target, args=None, fmt="json", debug=True, optimize=False):
         # TODO create ability to save cleaned code
         self.first_stage()
+        self.report = self.optimize() if optimize else list()
         self.second_stage()
 
-        json_text = json.dumps({"data": self.data, "code": self.code})
+        if fmt == "bin":
+            self._write_binary(target, debug)
+            return target
+
+        # memory the program needs, checked by DataPath.load_program
+        sizes = {"data_size": self._data_size(), "code_size": len(self.code)}
+        json_text = json.dumps({"data": self.data, "code": self.code, **sizes})
 
         f = open(target, "w")
         f.write(json_text)
@@ -180,12 +357,154 @@ class Translator:
 
         return target
 
+    def _data_size(self):
+        """
+        Data cells the program needs: its data and every static address of the code, jump targets
+        included, since DataPath.check_addresses requires them to fit the data memory as well
+        """
+        addrs = [
+            i["arg"] + 1
+            for i in self.code
+            if i["address_type"] in [Address.LABEL_ADDR, Address.LABEL_VAL, Address.INDIRECT]
+        ]
+        return max([len(data_to_mem(self.data)), *addrs])
+
+    def _write_binary(self, target, debug):
+        codes = [operation_to_code(i["opcode"], i["address_type"]) for i in self.code]
+        args = [i["arg"] for i in self.code]
+        # the binary format has no data size: the data is padded with zero cells up to it
+        mem = data_to_mem(self.data)
+        mem.extend([0] * (self._data_size() - len(mem)))
+
+        debug_info = None
+        if debug:
+            debug_info = {"code": [i["term"] for i in self.code], "data": [i["scr_line"] for i in self.data]}
+
+        write_binary(target, codes, args, mem, debug_info)
+
+
+TRANSLATION_CACHE_VERSION = 3
+
+
+def _region_key(section, lines):
+    return hashlib.sha256("\n".join([section, *lines]).encode()).hexdigest()
+
+
+def _decode_code_entries(entries):
+    """
+    Parsed code region from the JSON cache: opcodes and address types are stored as their values
+    """
+    return [
+        (label, dict(instr, opcode=Opcode(instr["opcode"]), address_type=Address(instr["address_type"])))
+        for label, instr in entries
+    ]
+
+
+class IncrementalTranslator(Translator):
+    """
+    Translator which keeps the results of the previous translation in `cache_file` (JSON):
+    parsed regions by the hash of their clean lines, and arguments of code regions
+    together with the label addresses they were resolved with. Unchanged regions are
+    not parsed again and keep their arguments unless one of these labels has moved.
+    The output is the same as of Translator.
+    """
+
+    def __init__(self, filename, cache_file):
+        super().__init__(filename)
+        self.cache_file = cache_file
+        self.old_cache = self._load_cache()
+        self.cache = {"version": TRANSLATION_CACHE_VERSION, "parsed": dict(), "resolved": dict()}
+        # (region key, number of instructions) of code regions in program order
+        self.code_regions = list()
+        self.stats = dict.fromkeys(["regions", "parsed", "code_regions", "relinked"], 0)
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {"parsed": dict(), "resolved": dict()}
+        if not isinstance(cache, dict) or cache.get("version") != TRANSLATION_CACHE_VERSION:
+            return {"parsed": dict(), "resolved": dict()}
+        return cache
+
+    def _parse_region(self, section, start, lines):
+        key = _region_key(section, lines)
+        self.stats["regions"] += 1
+        entries = self.cache["parsed"].get(key)
+        if entries is None and key in self.old_cache["parsed"]:
+            entries = self.old_cache["parsed"][key]
+            if section == "code":
+                entries = _decode_code_entries(entries)
+        if entries is None:
+            entries = super()._parse_region(section, start, lines)
+            self.stats["parsed"] += 1
+        self.cache["parsed"][key] = entries
+        if section == "code":
+            self.code_regions.append((key, len(entries)))
+        return entries
+
+    def second_stage(self):
+        if self.report:
+            # the optimizer has changed the code, it does not match the regions anymore
+            super().second_stage()
+            return
+
+        labels = {"code": self.code_labels, "data": self.data_labels}
+        first = 0
+        for key, size in self.code_regions:
+            instructions = self.code[first : first + size]
+            first += size
+            self.stats["code_regions"] += 1
+
+            old = self.old_cache["resolved"].get(key)
+            if old is not None and all(labels[kind].get(label) == addr for kind, label, addr in old[0]):
+                for instr, arg in zip(instructions, old[1]):
+                    instr["arg"] = arg
+                self.cache["resolved"][key] = old
+                continue
+
+            self.stats["relinked"] += 1
+            # [kind, label, address] of the labels the region uses
+            used = list()
+            for instr in instructions:
+                label = self._resolve(instr)
+                if label is not None:
+                    used.append([*label, instr["arg"]])
+            self.cache["resolved"][key] = (used, [i["arg"] for i in instructions])
+
+    def translate(self, target, args=None, fmt="json", debug=True, optimize=False):
+        super().translate(target, args, fmt, debug, optimize)
+        with open(self.cache_file, "w", encoding="utf-8") as f:
+            json.dump(self.cache, f)
+        return target
+
+    def reuse_report(self):
+        stats = self.stats
+        return (
+            f"Incremental: {stats['regions'] - stats['parsed']} of {stats['regions']} regions reused, "
+            f"{stats['relinked']} of {stats['code_regions']} code regions relinked"
+        )
+
 
-def main(source_file, target_file):
-    tr = Translator(source_file)
-    tr.translate(target_file)
+def main(source_file, target_file, fmt="json", debug=True, optimize=False, cache_file=None):
+    tr = Translator(source_file) if cache_file is None else IncrementalTranslator(source_file, cache_file)
+    tr.translate(target_file, fmt=fmt, debug=debug, optimize=optimize)
+    for change in tr.report:
+        print(change)
+    if cache_file is not None:
+        print(tr.reuse_report())
 
 
 if __name__ == "__main__":
-    source_file, target_file = sys.argv[1:]
-    main(source_file, target_file)
+    parser = argparse.ArgumentParser(description="Translator of the assembly language")
+    parser.add_argument("source_file")
+    parser.add_argument("target_file")
+    parser.add_argument("--format", choices=["json", "bin"], default="json", help="machine code format")
+    parser.add_argument("--no-debug", action="store_true", help="omit debug info from binary output")
+    parser.add_argument("-O", "--optimize", action="store_true", help="run the peephole optimizer and report changes")
+    parser.add_argument(
+        "--incremental", metavar="CACHE", help="reuse unchanged regions of the previous translation kept in CACHE"
+    )
+    args = parser.parse_args()
+    main(args.source_file, args.target_file, args.format, not args.no_debug, args.optimize, args.incremental)